@@ -51,6 +51,17 @@ class Settings(BaseSettings):
         description="Default daily send time (HH:MM format)"
     )
     
+    # Invoice processing
+    max_parallel_invoices: int = Field(
+        default=8,
+        ge=1,
+        description="Number of invoices processed concurrently per run"
+    )
+    filename_date_prefilter: bool = Field(
+        default=False,
+        description="Skip invoices by the date in their filename (RE-YYYYMMDD-*.pdf) without reading them"
+    )
+    
     # Web server settings
     host: str = Field(default="0.0.0.0", description="Web server host")
     port: int = Field(default=8000, description="Web server port")
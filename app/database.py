@@ -7,9 +7,9 @@ import logging
 from contextlib import contextmanager
 from typing import Generator
 
-from sqlalchemy import create_engine, event
+from sqlalchemy import create_engine, event, text
 from sqlalchemy.orm import sessionmaker, Session, declarative_base
-from sqlalchemy.pool import StaticPool
+from sqlalchemy.pool import QueuePool
 
 from app.config import get_settings
 
@@ -18,6 +18,12 @@ logger = logging.getLogger(__name__)
 # SQLAlchemy Base for model declarations
 Base = declarative_base()
 
+# Connection pool sizing for the web workers and scheduler threads
+POOL_SIZE = 20
+POOL_MAX_OVERFLOW = 10
+POOL_RECYCLE_SECONDS = 1800
+POOL_TIMEOUT_SECONDS = 30
+
 # Global engine and session factory
 _engine = None
 _SessionLocal = None
@@ -29,11 +35,18 @@ def get_engine():
     if _engine is None:
         settings = get_settings()
         
-        # Create engine with SQLite-specific settings
+        # Create engine with SQLite-specific settings.
+        # A real QueuePool (instead of a single shared connection) lets concurrent
+        # requests and the scheduler each check out their own connection.
         _engine = create_engine(
             settings.database_url,
             connect_args={"check_same_thread": False},
-            poolclass=StaticPool,
+            poolclass=QueuePool,
+            pool_size=POOL_SIZE,
+            max_overflow=POOL_MAX_OVERFLOW,
+            pool_pre_ping=True,
+            pool_recycle=POOL_RECYCLE_SECONDS,
+            pool_timeout=POOL_TIMEOUT_SECONDS,
             echo=settings.log_level == "DEBUG"
         )
         
@@ -49,6 +62,21 @@ def get_engine():
     return _engine
 
 
+def get_pool_status() -> dict:
+    """Get a snapshot of the connection pool usage."""
+    pool = get_engine().pool
+    checked_out = pool.checkedout()
+    overflow = pool.overflow()
+    return {
+        "size": pool.size(),
+        "checked_out": checked_out,
+        "overflow": overflow,
+        "max_overflow": POOL_MAX_OVERFLOW,
+        "saturated": overflow >= POOL_MAX_OVERFLOW,
+        "status": pool.status(),
+    }
+
+
 def get_session_factory():
     """Get or create the session factory."""
     global _SessionLocal
@@ -99,9 +127,25 @@ def init_db() -> None:
     
     engine = get_engine()
     Base.metadata.create_all(bind=engine)
+    _migrate_indexes(engine)
     logger.info("Database tables created successfully")
 
 
+def _migrate_indexes(engine) -> None:
+    """
+    Bring indexes of existing databases in line with the models.
+    create_all() only creates indexes together with new tables.
+    """
+    from app.models import EmailLog
+    
+    for index in EmailLog.__table__.indexes:
+        index.create(bind=engine, checkfirst=True)
+    
+    # Replaced by ix_email_logs_ts
+    with engine.begin() as conn:
+        conn.execute(text("DROP INDEX IF EXISTS ix_email_logs_timestamp"))
+
+
 def reset_db() -> None:
     """
     Reset the database by dropping and recreating all tables.
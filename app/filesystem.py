@@ -3,18 +3,23 @@ FileSystem abstraction layer to support both Local and Network (SMB) storage.
 Allows the application to work transparently with files regardless of their location.
 """
 
+import errno
+import fnmatch
+import itertools
 import os
 import shutil
 import logging
+import threading
 import time
 from abc import ABC, abstractmethod
-from typing import List, Dict, Union, Any, Optional
+from collections import OrderedDict
+from typing import List, Dict, Union, Any, Optional, Iterator
 from pathlib import Path
 
 # Try to import smbclient, but don't fail if not installed (graceful degradation)
 try:
     import smbclient
-    from smbprotocol.exceptions import SMBResponseException
+    from smbprotocol.exceptions import SMBOSError, SMBResponseException
     SMB_AVAILABLE = True
 except ImportError:
     SMB_AVAILABLE = False
@@ -22,15 +27,32 @@ except ImportError:
 
 logger = logging.getLogger(__name__)
 
+# Shared cache for list_files_cached(): (provider, path, pattern) -> (mtime, stored_at, files)
+LISTING_CACHE_SIZE = 8
+# Fallback lifetime for providers that can't report a folder mtime
+LISTING_CACHE_TTL_SECONDS = 5.0
+# Folders modified more recently than this aren't cached: a change within the same
+# mtime tick as the listing would otherwise go unnoticed
+LISTING_MTIME_SETTLE_SECONDS = 2.0
+_listing_cache: "OrderedDict[tuple, tuple]" = OrderedDict()
+_listing_cache_lock = threading.Lock()
+
 
 class FileSystemProvider(ABC):
     """Abstract base class for file system operations."""
     
+    # Identifies the storage behind a provider instance for shared caches
+    cache_key = ""
+    
     @abstractmethod
-    def list_directories(self, path: str) -> List[Dict[str, Any]]:
-        """List directories in the given path."""
+    def iter_directories(self, path: str) -> Iterator[Dict[str, Any]]:
+        """Yield directories in the given path (unsorted, as the backend returns them)."""
         pass
     
+    def list_directories(self, path: str) -> List[Dict[str, Any]]:
+        """List directories in the given path, sorted by name."""
+        return sorted(self.iter_directories(path), key=lambda x: x["name"].lower())
+    
     @abstractmethod
     def create_directory(self, path: str) -> None:
         """Create a directory."""
@@ -46,14 +68,62 @@ class FileSystemProvider(ABC):
         """Check if path is a directory."""
         pass
         
+    @abstractmethod
+    def iter_files(self, path: str, pattern: str = "*") -> Iterator[str]:
+        """Yield files in directory matching pattern (unsorted)."""
+        pass
+    
     @abstractmethod
     def list_files(self, path: str, pattern: str = "*") -> List[str]:
         """List files in directory matching pattern."""
         pass
+    
+    def get_mtime(self, path: str) -> Optional[float]:
+        """Get the modification time of path, or None if the backend can't tell cheaply."""
+        return None
+    
+    def list_files_cached(self, path: str, pattern: str = "*") -> List[str]:
+        """
+        list_files() backed by a small shared cache for repeated UI listings.
+        
+        A cached listing is reused while the folder's mtime is unchanged, which
+        costs one stat instead of a full directory read. Without an mtime the
+        listing is kept for LISTING_CACHE_TTL_SECONDS.
+        """
+        key = (self.cache_key, path, pattern)
+        try:
+            mtime = self.get_mtime(path)
+        except Exception:
+            mtime = None
+        
+        with _listing_cache_lock:
+            hit = _listing_cache.get(key)
+        if hit is not None:
+            cached_mtime, stored_at, files = hit
+            if mtime is not None:
+                fresh = cached_mtime == mtime
+            else:
+                fresh = cached_mtime is None and time.monotonic() - stored_at < LISTING_CACHE_TTL_SECONDS
+            if fresh:
+                return list(files)
+        
+        files = self.list_files(path, pattern)
+        # Empty results aren't cached (SMB listing errors also come back as [])
+        if files and (mtime is None or time.time() - mtime > LISTING_MTIME_SETTLE_SECONDS):
+            with _listing_cache_lock:
+                _listing_cache[key] = (mtime, time.monotonic(), tuple(files))
+                _listing_cache.move_to_end(key)
+                while len(_listing_cache) > LISTING_CACHE_SIZE:
+                    _listing_cache.popitem(last=False)
+        return files
         
     @abstractmethod
-    def move_file(self, src: str, dst: str) -> None:
-        """Move a file from src to dst."""
+    def move_file(self, src: str, dst: str, overwrite: bool = True) -> None:
+        """
+        Move a file from src to dst.
+        
+        With overwrite=False an existing dst is left alone and FileExistsError is raised.
+        """
         pass
         
     @abstractmethod
@@ -75,32 +145,30 @@ class FileSystemProvider(ABC):
 class LocalFileSystem(FileSystemProvider):
     """Implementation for local file system."""
     
-    def list_directories(self, path: str) -> List[Dict[str, Any]]:
+    cache_key = "local"
+    
+    def iter_directories(self, path: str) -> Iterator[Dict[str, Any]]:
         path = path.strip() or "/"
         if not os.path.exists(path):
-            return []
+            return
             
-        result = []
         try:
             with os.scandir(path) as it:
                 for entry in it:
                     if entry.is_dir():
-                        result.append({
+                        yield {
                             "name": entry.name,
                             "path": entry.path,
                             "has_children": True,  # Simplified assumption
                             "access_denied": False
-                        })
-            result.sort(key=lambda x: x["name"].lower())
+                        }
         except PermissionError:
             logger.warning(f"Permission denied accessing {path}")
-            # If we can't read the dir, we return empty list or indicate error
+            # If we can't read the dir, we yield nothing
             # For the browser UI, we might want to show the dir exists but is locked
             pass
         except Exception as e:
             logger.error(f"Error listing directories in {path}: {e}")
-            
-        return result
     
     def create_directory(self, path: str) -> None:
         os.makedirs(path, exist_ok=True)
@@ -111,6 +179,15 @@ class LocalFileSystem(FileSystemProvider):
     def is_dir(self, path: str) -> bool:
         return os.path.isdir(path)
         
+    def iter_files(self, path: str, pattern: str = "*") -> Iterator[str]:
+        if not self.exists(path):
+            return
+        
+        with os.scandir(path) as it:
+            for entry in it:
+                if fnmatch.fnmatchcase(entry.name, pattern):
+                    yield os.path.join(path, entry.name)
+    
     def list_files(self, path: str, pattern: str = "*") -> List[str]:
         if not self.exists(path):
             return []
@@ -120,16 +197,47 @@ class LocalFileSystem(FileSystemProvider):
         full_pattern = os.path.join(path, pattern)
         return glob.glob(full_pattern)
         
-    def move_file(self, src: str, dst: str) -> None:
-        # Ensure destination directory exists
-        dst_dir = os.path.dirname(dst)
-        if not self.exists(dst_dir):
+    def move_file(self, src: str, dst: str, overwrite: bool = True) -> None:
+        try:
+            self._move(src, dst, overwrite)
+        except FileNotFoundError:
+            # The destination directory is only checked when the move fails
+            dst_dir = os.path.dirname(dst)
+            if not dst_dir or self.exists(dst_dir):
+                raise
             self.create_directory(dst_dir)
-        shutil.move(src, dst)
+            self._move(src, dst, overwrite)
+    
+    def _move(self, src: str, dst: str, overwrite: bool) -> None:
+        if not overwrite:
+            try:
+                # link() refuses to replace dst, so the collision check is atomic
+                os.link(src, dst)
+            except (FileExistsError, FileNotFoundError):
+                raise
+            except OSError:
+                # No hard links here (other volume, FAT/CIFS mounts): check, then move
+                if os.path.exists(dst):
+                    raise FileExistsError(errno.EEXIST, "Zieldatei existiert bereits", dst)
+                shutil.move(src, dst)
+            else:
+                os.unlink(src)
+            return
+        try:
+            # Same volume: single atomic rename
+            os.replace(src, dst)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            # Different volume: copy + delete
+            shutil.move(src, dst)
         
     def read_file(self, path: str) -> bytes:
         with open(path, 'rb') as f:
             return f.read()
+    
+    def get_mtime(self, path: str) -> Optional[float]:
+        return os.stat(path).st_mtime
             
     def get_full_path(self, path: str) -> str:
         return os.path.abspath(path)
@@ -162,6 +270,8 @@ class SMBFileSystem(FileSystemProvider):
         self.username = f"{domain}\\{username}" if domain else username
         self.password = password
         self.domain = domain
+        # Listings are only shared between instances that see the same share as the same user
+        self.cache_key = f"smb://{self.username}@{host}/{share}"
         
         # Register session
         # Note: smbclient handles session reuse internally
@@ -181,14 +291,21 @@ class SMBFileSystem(FileSystemProvider):
         for attempt in range(retries):
             try:
                 return func(*args, **kwargs)
+            except FileExistsError:
+                # A name collision is an answer, not a connection problem
+                raise
             except Exception as e:
                 last_exc = e
                 if attempt < retries - 1:
-                    # Clear cached connections and back off
-                    try:
-                        smbclient.reset_connection_cache()
-                    except Exception:
-                        pass
+                    # File-level errors (SMBOSError carrying an NTSTATUS: sharing violation,
+                    # not found, ...) come over a healthy connection; only reset the shared
+                    # connection cache for anything else (including socket errors such as
+                    # ConnectionResetError), since that also aborts other workers' requests
+                    if not isinstance(e, SMBOSError):
+                        try:
+                            smbclient.reset_connection_cache()
+                        except Exception:
+                            pass
                     time.sleep(delay * (attempt + 1))
                     continue
                 raise last_exc
@@ -225,27 +342,32 @@ class SMBFileSystem(FileSystemProvider):
 
         return f"{base}\\{rel_backslash}" if rel_backslash else base
 
-    def list_directories(self, path: str) -> List[Dict[str, Any]]:
+    def iter_directories(self, path: str) -> Iterator[Dict[str, Any]]:
         rel_path = self._normalize_rel_path(path)
         full_path = self._get_smb_path(rel_path)
-        def _list():
-            result = []
-            for filename in smbclient.listdir(full_path):
-                file_path = self._join_unc(full_path, filename)
-                if smbclient.path.isdir(file_path):
+
+        def _first_batch():
+            # scandir is lazy: the first entry triggers opening the directory and the
+            # first QUERY_DIRECTORY response, which is what usually fails on a flaky share
+            entries = smbclient.scandir(full_path)
+            return entries, next(entries, None)
+
+        try:
+            # scandir returns the file attributes with the directory listing,
+            # so no extra isdir() round-trip per entry is needed.
+            entries, first = self._with_retries(_first_batch)
+            if first is None:
+                return
+            for entry in itertools.chain((first,), entries):
+                if entry.is_dir():
                     # Keep relative path so browser can drill down
-                    next_rel = f"{rel_path}/{filename}" if rel_path else filename
-                    result.append({
-                        "name": filename,
+                    next_rel = f"{rel_path}/{entry.name}" if rel_path else entry.name
+                    yield {
+                        "name": entry.name,
                         "path": next_rel,
                         "has_children": True,
                         "access_denied": False
-                    })
-            result.sort(key=lambda x: x["name"].lower())
-            return result
-
-        try:
-            return self._with_retries(_list)
+                    }
         except SMBResponseException as e:
             logger.error(f"SMB list error at {full_path}: {e}")
             # Surface access issues to the caller instead of silently hiding them
@@ -271,15 +393,31 @@ class SMBFileSystem(FileSystemProvider):
         except Exception:
             return False
             
+    def iter_files(self, path: str, pattern: str = "*") -> Iterator[str]:
+        # The server applies the wildcard mask (SMB2 QUERY_DIRECTORY), so only matching
+        # entries cross the wire; fnmatch keeps the local case-sensitivity semantics.
+        # The names are collected inside _with_retries so a transient error while reading
+        # the directory retries the whole scan; only the (short) name list is buffered.
+        full_path = self._get_smb_path(path)
+        rel_path = self._normalize_rel_path(path)
+        
+        def _scan():
+            return [
+                entry.name for entry in smbclient.scandir(full_path, search_pattern=pattern)
+                if fnmatch.fnmatch(entry.name, pattern)
+            ]
+        
+        for name in self._with_retries(_scan):
+            yield os.path.join(rel_path, name) # Return 'relative' path for internal use
+    
     def list_files(self, path: str, pattern: str = "*") -> List[str]:
-        # smbclient doesn't have glob, so we filter listdir
+        # Let the server filter by the wildcard mask, then match locally as well
         full_path = self._get_smb_path(path)
         files = []
         try:
-            import fnmatch
             def _list():
                 local_files = []
-                for filename in smbclient.listdir(full_path):
+                for filename in smbclient.listdir(full_path, search_pattern=pattern):
                     if fnmatch.fnmatch(filename, pattern):
                         local_files.append(os.path.join(self._normalize_rel_path(path), filename)) # Return 'relative' path for internal use
                 return local_files
@@ -289,7 +427,7 @@ class SMBFileSystem(FileSystemProvider):
             
         return files
         
-    def move_file(self, src: str, dst: str) -> None:
+    def move_file(self, src: str, dst: str, overwrite: bool = True) -> None:
         # Note: Moving between filesystems (Local <-> SMB) needs special handling
         # This generic move assumes source and dest are on THIS filesystem
         # If the app mixes them, we need higher level logic.
@@ -298,32 +436,55 @@ class SMBFileSystem(FileSystemProvider):
         src_full = self._get_smb_path(src)
         dst_full = self._get_smb_path(dst)
         
+        def _rename():
+            # Server-side rename (SMB2 SET_INFO); replace() overwrites an existing
+            # target in the same request, rename() fails with a name collision
+            if overwrite:
+                smbclient.replace(src_full, dst_full)
+            else:
+                smbclient.rename(src_full, dst_full)
+        
         def _move():
-            # Ensure dest dir exists
-            # Use split to get directory since smbclient.path might not have dirname
-            dst_dir = "\\".join(dst_full.split("\\")[:-1])
-            if not smbclient.path.exists(dst_dir):
-                smbclient.makedirs(dst_dir)
-            
             try:
-                # If target exists, remove it to avoid rename errors
-                if smbclient.path.exists(dst_full):
-                    smbclient.remove(dst_full)
-                smbclient.rename(src_full, dst_full)
-            except Exception as e:
+                try:
+                    _rename()
+                except OSError as e:
+                    if e.errno != errno.ENOENT:
+                        raise
+                    # Dest dir is only created when the rename reports it missing
+                    # Use split to get directory since smbclient.path might not have dirname
+                    dst_dir = "\\".join(dst_full.split("\\")[:-1])
+                    smbclient.makedirs(dst_dir, exist_ok=True)
+                    _rename()
+            except OSError as e:
+                if e.errno == errno.EEXIST and not overwrite:
+                    # STATUS_OBJECT_NAME_COLLISION
+                    raise FileExistsError(errno.EEXIST, "Zieldatei existiert bereits", dst) from e
                 logger.error(f"SMB rename failed {src_full} -> {dst_full}: {e}, trying copy/delete fallback.")
-                # Fallback: copy then delete
-                with smbclient.open_file(src_full, mode='rb') as src_f, smbclient.open_file(dst_full, mode='wb') as dst_f:
-                    shutil.copyfileobj(src_f, dst_f)
+                # Fallback: copy then delete ('xb' refuses to replace an existing target)
+                try:
+                    with smbclient.open_file(src_full, mode='rb') as src_f, \
+                            smbclient.open_file(dst_full, mode='wb' if overwrite else 'xb') as dst_f:
+                        shutil.copyfileobj(src_f, dst_f)
+                except OSError as copy_error:
+                    if copy_error.errno == errno.EEXIST and not overwrite:
+                        raise FileExistsError(errno.EEXIST, "Zieldatei existiert bereits", dst) from copy_error
+                    raise
                 smbclient.remove(src_full)
 
         self._with_retries(_move)
         
     def read_file(self, path: str) -> bytes:
         def _read():
-            with smbclient.open_file(self._get_smb_path(path), mode='rb') as f:
+            # Allow other readers (e.g. someone viewing the PDF) instead of failing
+            # with a sharing violation and retrying
+            with smbclient.open_file(self._get_smb_path(path), mode='rb', share_access='r') as f:
                 return f.read()
         return self._with_retries(_read)
+    
+    def get_mtime(self, path: str) -> Optional[float]:
+        # Single stat round-trip, no retries: on failure the caller just lists again
+        return smbclient.stat(self._get_smb_path(path)).st_mtime
             
     def get_full_path(self, path: str) -> str:
         return self._get_smb_path(path)
@@ -8,7 +8,7 @@ import re
 from dataclasses import dataclass
 from datetime import datetime, date
 from pathlib import Path
-from typing import Optional, Tuple, List, Union, BinaryIO
+from typing import Optional, Tuple, Union, BinaryIO, Iterator
 from io import BytesIO
 
 import pikepdf
@@ -58,12 +58,12 @@ ZUGFERD_XML_FILENAMES = [
 ]
 
 
-def extract_xml_from_pdf(pdf_source: Union[Path, str, BinaryIO]) -> Optional[str]:
+def extract_xml_from_pdf(pdf_source: Union[Path, str, BinaryIO, bytes]) -> Optional[str]:
     """
     Extract embedded ZUGFeRD/Factur-X XML from a PDF file.
     
     Args:
-        pdf_source: Path to the PDF file or file-like object
+        pdf_source: Path to the PDF file, file-like object or raw PDF bytes
         
     Returns:
         XML content as string, or None if not found
@@ -71,6 +71,10 @@ def extract_xml_from_pdf(pdf_source: Union[Path, str, BinaryIO]) -> Optional[str
     Raises:
         ZUGFeRDParseError: If PDF cannot be read or processed
     """
+    if isinstance(pdf_source, bytes):
+        # BytesIO shares the buffer of a bytes object, so this doesn't copy the PDF
+        pdf_source = BytesIO(pdf_source)
+    
     try:
         # pikepdf.open handles paths and file-like objects
         with pikepdf.open(pdf_source) as pdf:
@@ -347,12 +351,12 @@ def parse_buyer_name(xml_content: str) -> Optional[str]:
         return None
 
 
-def parse_invoice(pdf_source: Union[Path, str, BinaryIO], filename: str = "") -> InvoiceData:
+def parse_invoice(pdf_source: Union[Path, str, BinaryIO, bytes], filename: str = "") -> InvoiceData:
     """
     Parse a ZUGFeRD/Factur-X invoice PDF and extract relevant data.
     
     Args:
-        pdf_source: Path to the PDF invoice file or file-like object
+        pdf_source: Path to the PDF invoice file, file-like object or raw PDF bytes
         filename: Optional filename for logging/identification
         
     Returns:
@@ -361,7 +365,12 @@ def parse_invoice(pdf_source: Union[Path, str, BinaryIO], filename: str = "") ->
     Raises:
         ZUGFeRDParseError: If parsing fails
     """
-    log_name = filename or str(pdf_source)
+    if filename:
+        log_name = filename
+    elif isinstance(pdf_source, bytes):
+        log_name = f"<{len(pdf_source)} bytes>"
+    else:
+        log_name = str(pdf_source)
     logger.info(f"Parsing invoice: {log_name}")
     
     # Extract XML from PDF
@@ -393,7 +402,7 @@ def parse_invoice(pdf_source: Union[Path, str, BinaryIO], filename: str = "") ->
     return invoice_data
 
 
-def find_invoice_files(source_folder: Path, pattern: str = "RE-*.pdf") -> List[Path]:
+def find_invoice_files(source_folder: Path, pattern: str = "RE-*.pdf") -> Iterator[Path]:
     """
     Find invoice PDF files matching the pattern in the source folder.
     
@@ -401,18 +410,18 @@ def find_invoice_files(source_folder: Path, pattern: str = "RE-*.pdf") -> List[P
         source_folder: Directory to search
         pattern: Glob pattern for invoice files (default: RE-*.pdf)
         
-    Returns:
-        List of matching file paths
+    Yields:
+        Matching file paths (in directory order, without building a full list)
+    
+    Unlike the former list version, the paths are not sorted and no file count
+    is logged; callers that need either collect the paths themselves.
     """
     if not source_folder.exists():
         logger.warning(f"Source folder does not exist: {source_folder}")
-        return []
+        return
     
     if not source_folder.is_dir():
         logger.warning(f"Source path is not a directory: {source_folder}")
-        return []
-    
-    files = list(source_folder.glob(pattern))
-    logger.info(f"Found {len(files)} invoice files in {source_folder}")
+        return
     
-    return sorted(files)
+    yield from source_folder.glob(pattern)
@@ -7,12 +7,16 @@ import base64
 import logging
 import os
 import ssl
+import threading
+import time
 from pathlib import Path
 from typing import Optional, Union
 
 import msal
 import requests # Import requests library
 
+from requests.adapters import HTTPAdapter
+
 from app.config import get_settings
 
 logger = logging.getLogger(__name__)
@@ -37,6 +41,23 @@ class GraphMailService:
     GRAPH_API_ENDPOINT = "https://graph.microsoft.com/v1.0"
     SCOPE = ["https://graph.microsoft.com/.default"]
     
+    # Graph throttles concurrent requests per mailbox (HTTP 429/503 with Retry-After);
+    # parallel invoice workers wait and retry instead of failing the invoice
+    THROTTLE_STATUS_CODES = (429, 503)
+    MAX_SEND_ATTEMPTS = 3
+    MAX_RETRY_AFTER_SECONDS = 30
+    
+    # Renew the cached access token this long before Azure AD says it expires
+    TOKEN_EXPIRY_MARGIN_SECONDS = 300
+    
+    # Keep-alive connections to graph.microsoft.com shared by the parallel invoice workers
+    HTTP_POOL_MAXSIZE = 16
+    
+    # sendMail only takes inline attachments up to ~3 MB (request size, base64 included);
+    # larger files go through a draft and an upload session in raw chunks
+    LARGE_ATTACHMENT_BYTES = 3 * 1024 * 1024 * 3 // 4
+    UPLOAD_CHUNK_BYTES = 10 * 320 * 1024  # must be a multiple of 320 KiB
+    
     def __init__(self, tenant_id: str = None, client_id: str = None, 
                  client_secret: str = None, sender_address: str = None):
         """
@@ -73,7 +94,14 @@ class GraphMailService:
             self.sender_address = self.env_settings.sender_address
 
         self._app: Optional[msal.ConfidentialClientApplication] = None
-        self._token_cache: Optional[dict] = None
+        # Access token reused until shortly before it expires (time.monotonic() deadline)
+        self._access_token: Optional[str] = None
+        self._token_expires_at = 0.0
+        self._token_lock = threading.Lock()
+        
+        # One HTTP session for all Graph calls so TLS connections are reused across invoices
+        self._http = requests.Session()
+        self._http.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=self.HTTP_POOL_MAXSIZE))
         self._ca_bundle: Optional[str] = None
 
     def _ensure_ca_bundle(self) -> str:
@@ -171,6 +199,9 @@ class GraphMailService:
         self.client_secret = client_secret
         self.sender_address = sender_address
         self._app = None  # Force recreation on next use
+        with self._token_lock:
+            self._access_token = None
+            self._token_expires_at = 0.0
     
     def get_access_token(self) -> str:
         """
@@ -182,21 +213,47 @@ class GraphMailService:
         Raises:
             GraphMailError: If token acquisition fails
         """
-        # Try to get token from cache first
-        result = self.app.acquire_token_silent(self.SCOPE, account=None)
-        
-        if not result:
-            logger.debug("No cached token, acquiring new token")
-            result = self.app.acquire_token_for_client(scopes=self.SCOPE)
+        # Fast path: token from an earlier call that is still valid
+        token = self._access_token
+        if token and time.monotonic() < self._token_expires_at:
+            return token
         
-        if "access_token" in result:
-            logger.debug("Successfully acquired access token")
-            return result["access_token"]
+        # One thread renews the token, the others wait and reuse it
+        with self._token_lock:
+            if self._access_token and time.monotonic() < self._token_expires_at:
+                return self._access_token
+            
+            # Try to get token from cache first
+            result = self.app.acquire_token_silent(self.SCOPE, account=None)
+            
+            if not result:
+                logger.debug("No cached token, acquiring new token")
+                result = self.app.acquire_token_for_client(scopes=self.SCOPE)
+            
+            if "access_token" in result:
+                logger.debug("Successfully acquired access token")
+                expires_in = int(result.get("expires_in") or 0)
+                self._access_token = result["access_token"]
+                self._token_expires_at = time.monotonic() + max(expires_in - self.TOKEN_EXPIRY_MARGIN_SECONDS, 0)
+                return result["access_token"]
         
         error_description = result.get("error_description", "Unknown error")
         error = result.get("error", "unknown")
         raise GraphMailError(f"Failed to acquire token: {error} - {error_description}")
     
+    def ensure_token(self) -> None:
+        """
+        Acquire the access token up front so it is cached on this instance.
+        
+        Call this before sending a batch: later get_access_token() calls then reuse
+        the cached token (until shortly before it expires) instead of each worker
+        requesting its own.
+        
+        Raises:
+            GraphMailError: If token acquisition fails
+        """
+        self.get_access_token()
+    
     def send_email(
         self,
         to_email: str,
@@ -204,7 +261,7 @@ class GraphMailService:
         body: str,
         attachment_path: Optional[Union[Path, str]] = None,
         attachment_name: Optional[str] = None,
-        attachment_content: Optional[bytes] = None,
+        attachment_content: Optional[Union[bytes, memoryview]] = None,
     ) -> dict:
         """
         Send an email using Microsoft Graph API.
@@ -215,7 +272,7 @@ class GraphMailService:
             body: Email body (plain text)
             attachment_path: Optional path to PDF attachment (local file)
             attachment_name: Optional custom name for attachment (defaults to filename)
-            attachment_content: Optional bytes content (overrides reading from path)
+            attachment_content: Optional bytes-like content (overrides reading from path)
             
         Returns:
             API response as dict
@@ -247,6 +304,18 @@ class GraphMailService:
             "saveToSentItems": True
         }
         
+        # Explicitly set From/Sender to enforce the configured Absender
+        message["message"]["from"] = {
+            "emailAddress": {
+                "address": self.sender_address
+            }
+        }
+        message["message"]["sender"] = {
+            "emailAddress": {
+                "address": self.sender_address
+            }
+        }
+        
         # Add attachment if provided
         final_content = None
         final_name = attachment_name
@@ -262,8 +331,15 @@ class GraphMailService:
                 if final_name is None:
                     final_name = path_obj.name
 
+        if final_content and len(final_content) > self.LARGE_ATTACHMENT_BYTES:
+            return self._send_with_upload_session(
+                message["message"], final_content, final_name, access_token, to_email, subject
+            )
+        
         if final_content:
-            attachment_base64 = base64.b64encode(final_content).decode('utf-8')
+            # b64encode works on any buffer, so the PDF itself is never copied;
+            # the result is pure ASCII, which decodes without a UTF-8 scan
+            attachment_base64 = base64.b64encode(memoryview(final_content)).decode('ascii')
             
             message["message"]["attachments"] = [
                 {
@@ -283,21 +359,11 @@ class GraphMailService:
             "Content-Type": "application/json"
         }
 
-        # Explicitly set From/Sender to enforce the configured Absender
-        message["message"]["from"] = {
-            "emailAddress": {
-                "address": self.sender_address
-            }
-        }
-        message["message"]["sender"] = {
-            "emailAddress": {
-                "address": self.sender_address
-            }
-        }
-        
         try:
-            response = requests.post(
+            response = self._request_with_retries(
+                "POST",
                 endpoint,
+                f"sending to {to_email}",
                 headers=headers,
                 json=message,
                 timeout=30,
@@ -308,20 +374,153 @@ class GraphMailService:
                 logger.info(f"Email sent successfully to {to_email}")
                 return {"status": "sent", "recipient": to_email, "subject": subject}
             
-            # Handle error response
-            try:
-                error_data = response.json()
-                error_message = error_data.get("error", {}).get("message", response.text)
-            except Exception:
-                error_message = response.text
-            
             raise GraphMailError(
-                f"Failed to send email: HTTP {response.status_code} - {error_message}"
+                f"Failed to send email: HTTP {response.status_code} - {self._error_message(response)}"
             )
             
         except requests.RequestException as e:
             raise GraphMailError(f"Network error sending email: {e}")
     
+    def _send_with_upload_session(
+        self,
+        message: dict,
+        content: Union[bytes, memoryview],
+        name: str,
+        access_token: str,
+        to_email: str,
+        subject: str,
+    ) -> dict:
+        """
+        Send a message whose attachment is too large for sendMail.
+        
+        Creates a draft, uploads the attachment in raw chunks through an upload
+        session (no base64), then sends the draft. The draft is deleted again if
+        any step before sending fails.
+        """
+        base_url = f"{self.GRAPH_API_ENDPOINT}/users/{self.sender_address}/messages"
+        headers = {
+            "Authorization": f"Bearer {access_token}",
+            "Content-Type": "application/json"
+        }
+        verify = self._ca_bundle or True
+        data = memoryview(content)
+        total = len(data)
+        logger.info(f"Attachment {name} has {total} bytes, sending via upload session")
+        
+        message_id = None
+        try:
+            response = self._request_with_retries(
+                "POST", base_url, f"creating the draft for {to_email}",
+                headers=headers, json=message, timeout=30, verify=verify
+            )
+            if response.status_code != 201:
+                raise GraphMailError(
+                    f"Failed to create draft: HTTP {response.status_code} - {self._error_message(response)}"
+                )
+            message_id = response.json()["id"]
+            
+            response = self._request_with_retries(
+                "POST",
+                f"{base_url}/{message_id}/attachments/createUploadSession",
+                f"creating the upload session for {name}",
+                headers=headers,
+                json={
+                    "AttachmentItem": {
+                        "attachmentType": "file",
+                        "name": name,
+                        "size": total,
+                        "contentType": "application/pdf",
+                    }
+                },
+                timeout=30,
+                verify=verify,
+            )
+            if response.status_code != 201:
+                raise GraphMailError(
+                    f"Failed to create upload session: HTTP {response.status_code} - {self._error_message(response)}"
+                )
+            upload_url = response.json()["uploadUrl"]
+            
+            # The upload URL is pre-authorized; an Authorization header would be rejected
+            for start in range(0, total, self.UPLOAD_CHUNK_BYTES):
+                chunk = data[start:start + self.UPLOAD_CHUNK_BYTES]
+                end = start + len(chunk) - 1
+                response = self._request_with_retries(
+                    "PUT",
+                    upload_url,
+                    f"uploading {name}",
+                    headers={
+                        "Content-Type": "application/octet-stream",
+                        "Content-Length": str(len(chunk)),
+                        "Content-Range": f"bytes {start}-{end}/{total}",
+                    },
+                    data=chunk,
+                    timeout=60,
+                    verify=verify,
+                )
+                if response.status_code not in (200, 201):
+                    raise GraphMailError(
+                        f"Failed to upload attachment: HTTP {response.status_code} - {self._error_message(response)}"
+                    )
+            
+            # From here on the draft may already be on its way, so it must not be deleted
+            draft_id, message_id = message_id, None
+            response = self._request_with_retries(
+                "POST", f"{base_url}/{draft_id}/send", f"sending to {to_email}",
+                headers=headers, timeout=30, verify=verify
+            )
+            if response.status_code != 202:
+                raise GraphMailError(
+                    f"Failed to send email: HTTP {response.status_code} - {self._error_message(response)}"
+                )
+        except (GraphMailError, requests.RequestException, KeyError, ValueError) as e:
+            if message_id is not None:
+                self._delete_draft(base_url, message_id, headers)
+            if isinstance(e, GraphMailError):
+                raise
+            raise GraphMailError(f"Network error sending email: {e}")
+        
+        logger.info(f"Email sent successfully to {to_email}")
+        return {"status": "sent", "recipient": to_email, "subject": subject}
+    
+    def _delete_draft(self, base_url: str, message_id: str, headers: dict) -> None:
+        """Best-effort removal of a draft left over from a failed large send."""
+        try:
+            self._http.delete(f"{base_url}/{message_id}", headers=headers, timeout=30, verify=self._ca_bundle or True)
+        except requests.RequestException as e:
+            logger.warning(f"Could not delete draft {message_id}: {e}")
+    
+    @staticmethod
+    def _error_message(response: requests.Response) -> str:
+        """Extract the Graph error message from a response, falling back to the raw body."""
+        try:
+            return response.json().get("error", {}).get("message", response.text)
+        except Exception:
+            return response.text
+    
+    def _request_with_retries(self, method: str, url: str, action: str, **kwargs) -> requests.Response:
+        """Send a Graph request, waiting and retrying while Graph throttles it (HTTP 429/503)."""
+        for attempt in range(1, self.MAX_SEND_ATTEMPTS + 1):
+            response = self._http.request(method, url, **kwargs)
+            if response.status_code not in self.THROTTLE_STATUS_CODES or attempt == self.MAX_SEND_ATTEMPTS:
+                return response
+            # Throttled requests were not accepted, so repeating them can't duplicate
+            # a mail, draft or uploaded range
+            wait = self._retry_after_seconds(response, attempt)
+            logger.warning(
+                f"Graph throttled {action} (HTTP {response.status_code}), "
+                f"retrying in {wait:.0f}s (attempt {attempt}/{self.MAX_SEND_ATTEMPTS})"
+            )
+            time.sleep(wait)
+    
+    def _retry_after_seconds(self, response: requests.Response, attempt: int) -> float:
+        """Get the wait time from the Retry-After header, or back off linearly without it."""
+        try:
+            wait = float(response.headers.get("Retry-After", ""))
+        except ValueError:
+            wait = 2.0 * attempt
+        return min(max(wait, 0.0), self.MAX_RETRY_AFTER_SECONDS)
+    
     def test_connection(self) -> dict:
         """
         Test the Graph API connection by acquiring a token.
@@ -347,8 +546,9 @@ class GraphMailService:
             raise GraphMailError(f"Connection test failed: {e}")
 
 
-# Global service instance
+# Global service instances (env-configured and explicitly configured)
 _mail_service: Optional[GraphMailService] = None
+_configured_mail_service: Optional[GraphMailService] = None
 
 
 def get_mail_service(tenant_id: str = None, client_id: str = None,
@@ -356,19 +556,28 @@ def get_mail_service(tenant_id: str = None, client_id: str = None,
     """
     Get or create the mail service instance.
     
-    If credentials are provided, creates a new instance with those credentials.
+    If credentials are provided, returns an instance for those credentials; the instance
+    (and with it the cached access token and HTTP session) is reused as long as the
+    credentials don't change.
     Otherwise returns the cached instance or creates one with env settings.
     """
-    global _mail_service
+    global _mail_service, _configured_mail_service
     
     if tenant_id is not None and client_id is not None and client_secret is not None and sender_address is not None:
-        # Create new instance with provided credentials (allow empty strings to indicate explicit override)
-        return GraphMailService(
+        # Allow empty strings to indicate explicit override
+        service = _configured_mail_service
+        if service is not None and (
+            service.tenant_id, service.client_id, service.client_secret, service.sender_address
+        ) == (tenant_id, client_id, client_secret, sender_address):
+            return service
+        service = GraphMailService(
             tenant_id=tenant_id,
             client_id=client_id,
             client_secret=client_secret,
             sender_address=sender_address
         )
+        _configured_mail_service = service
+        return service
     
     if _mail_service is None:
         _mail_service = GraphMailService()
@@ -3,28 +3,31 @@ FastAPI Application for PPV Rechnung Versenden.
 Provides web UI for settings and logs, plus API endpoints.
 """
 
+import asyncio
+import json
 import logging
 import re
 import sys
 from contextlib import asynccontextmanager
 from datetime import datetime, date
 from pathlib import Path
-from typing import Optional
-from io import BytesIO
+from typing import Optional, Iterator, List, Dict, Any
 import secrets
 import os
+from uuid import uuid4
+from urllib.parse import urlencode
 
 import bcrypt
 from fastapi import FastAPI, Request, Depends, Form, HTTPException, status, Body, UploadFile, File, Response
-from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse, FileResponse
+from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse, FileResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
 from sqlalchemy.orm import Session
 
 from app.config import get_settings
-from app.database import init_db, get_db, get_db_session
-from app.models import AppSettings, EmailLog
+from app.database import init_db, get_db, get_db_session, get_pool_status
+from app.models import AppSettings, EmailLog, invalidate_settings_cache
 from app.filesystem import get_filesystem
 from app.scheduler import (
     start_scheduler,
@@ -32,8 +35,9 @@ from app.scheduler import (
     reschedule_daily_job,
     run_now,
     get_next_run_time,
-    TIMEZONE,
-    render_email_template
+    get_today,
+    render_email_template,
+    validate_template
 )
 from app.invoice_parser import parse_invoice, ZUGFeRDParseError
 from app.mail_service import get_mail_service, GraphMailService, GraphMailError
@@ -188,12 +192,11 @@ async def home(request: Request, user=Depends(require_basic_auth)):
 @app.get("/settings", response_class=HTMLResponse)
 async def settings_page(request: Request, db: Session = Depends(get_db), user=Depends(require_basic_auth)):
     """Display settings page."""
-    settings = AppSettings.get_all_settings(db)
+    settings, ms_settings = AppSettings.get_bundle(db)
     next_run = get_next_run_time()
     
     # Test Graph API connection using DB settings
     connection_status = None
-    ms_settings = AppSettings.get_microsoft_settings(db)
     
     # Check if credentials are configured
     if ms_settings['tenant_id'] and ms_settings['client_id'] and ms_settings['client_secret']:
@@ -255,12 +258,10 @@ async def save_settings(
     
     # Validate folders (depends on storage type)
     if storage_type == "local":
-        source_path = Path(source_folder)
-        if not source_path.is_absolute():
+        if not os.path.isabs(source_folder):
             errors.append("Quellordner muss ein absoluter Pfad sein (bei lokaler Speicherung)")
         
-        target_path = Path(target_folder)
-        if not target_path.is_absolute():
+        if not os.path.isabs(target_folder):
             errors.append("Zielordner muss ein absoluter Pfad sein (bei lokaler Speicherung)")
     elif storage_type == "smb":
         if not smb_host or not smb_share:
@@ -294,47 +295,58 @@ async def save_settings(
     
     if errors:
         return RedirectResponse(
-            url=f"/settings?error={'; '.join(errors)}",
+            url="/settings?" + urlencode({"error": "; ".join(errors)}),
             status_code=302
         )
     
-    # Save folder and schedule settings
-    AppSettings.set(db, AppSettings.KEY_SOURCE_FOLDER, source_folder.strip())
-    AppSettings.set(db, AppSettings.KEY_TARGET_FOLDER, target_folder.strip())
-    AppSettings.set(db, AppSettings.KEY_SEND_TIME, send_time.strip())
-    AppSettings.set(db, AppSettings.KEY_EMAIL_TEMPLATE, email_template)
-    AppSettings.set(db, AppSettings.KEY_SEND_PAST_DATES, "true" if send_past_dates else "false")
+    # Compare against the stored rows, not get_all_settings(): a value that only equals
+    # the .env fallback still has to be written, or it is lost when .env changes
+    current = AppSettings.get_stored_values(db)
     
-    # Save Storage settings
-    AppSettings.set(db, AppSettings.KEY_STORAGE_TYPE, storage_type)
-    AppSettings.set(db, AppSettings.KEY_SMB_HOST, smb_host.strip())
-    AppSettings.set(db, AppSettings.KEY_SMB_SHARE, smb_share.strip())
-    AppSettings.set(db, AppSettings.KEY_SMB_USERNAME, smb_username.strip())
+    # Folder and schedule settings
+    new_values = {
+        AppSettings.KEY_SOURCE_FOLDER: source_folder.strip(),
+        AppSettings.KEY_TARGET_FOLDER: target_folder.strip(),
+        AppSettings.KEY_SEND_TIME: send_time.strip(),
+        AppSettings.KEY_EMAIL_TEMPLATE: validate_template(email_template),
+        AppSettings.KEY_SEND_PAST_DATES: "true" if send_past_dates else "false",
+        # Storage settings
+        AppSettings.KEY_STORAGE_TYPE: storage_type,
+        AppSettings.KEY_SMB_HOST: smb_host.strip(),
+        AppSettings.KEY_SMB_SHARE: smb_share.strip(),
+        AppSettings.KEY_SMB_USERNAME: smb_username.strip(),
+        AppSettings.KEY_SMB_DOMAIN: smb_domain.strip(),
+    }
     if smb_password.strip(): # Only update password if provided
-        AppSettings.set(db, AppSettings.KEY_SMB_PASSWORD, smb_password.strip())
-    AppSettings.set(db, AppSettings.KEY_SMB_DOMAIN, smb_domain.strip())
+        new_values[AppSettings.KEY_SMB_PASSWORD] = smb_password.strip()
     
-    # Save Microsoft Graph settings (only if provided)
+    # Microsoft Graph settings (only if provided)
     if tenant_id.strip():
-        AppSettings.set(db, AppSettings.KEY_TENANT_ID, tenant_id.strip())
+        new_values[AppSettings.KEY_TENANT_ID] = tenant_id.strip()
     if client_id.strip():
-        AppSettings.set(db, AppSettings.KEY_CLIENT_ID, client_id.strip())
+        new_values[AppSettings.KEY_CLIENT_ID] = client_id.strip()
     if client_secret.strip():
-        AppSettings.set(db, AppSettings.KEY_CLIENT_SECRET, client_secret.strip())
+        new_values[AppSettings.KEY_CLIENT_SECRET] = client_secret.strip()
     if sender_address.strip():
-        AppSettings.set(db, AppSettings.KEY_SENDER_ADDRESS, sender_address.strip())
+        new_values[AppSettings.KEY_SENDER_ADDRESS] = sender_address.strip()
 
-    # Save admin credentials (hashed password)
+    # Admin credentials (hashed password)
     if admin_user_val:
-        AppSettings.set(db, AppSettings.KEY_ADMIN_USER, admin_user_val)
+        new_values[AppSettings.KEY_ADMIN_USER] = admin_user_val
+    
+    # Only write values that actually differ from what is stored (missing rows always differ)
+    changes = {k: v for k, v in new_values.items() if current.get(k) != v}
     if admin_pass_val:
         hashed = bcrypt.hashpw(admin_pass_val.encode("utf-8"), bcrypt.gensalt()).decode("utf-8")
-        AppSettings.set(db, AppSettings.KEY_ADMIN_PASSWORD_HASH, hashed)
+        changes[AppSettings.KEY_ADMIN_PASSWORD_HASH] = hashed
     
-    db.commit()
+    if changes:
+        AppSettings.set_many(db, changes)
+        db.commit()
     
-    # Reschedule the daily job with new time
-    reschedule_daily_job(send_time.strip())
+    # Reschedule the daily job only if the time changed
+    if AppSettings.KEY_SEND_TIME in changes:
+        reschedule_daily_job(send_time.strip())
     
     # Update .env in project root so systemd / external tools can use the same credentials
     # (This does not replace DB settings; it only ensures the environment file is in sync if created from installer)
@@ -385,7 +397,7 @@ async def save_settings(
         logger.warning(f"Failed to update .env file: {e}")
     
     return RedirectResponse(
-        url="/settings?message=Einstellungen gespeichert",
+        url="/settings?" + urlencode({"message": "Einstellungen gespeichert"}),
         status_code=302
     )
 
@@ -394,7 +406,8 @@ async def save_settings(
 async def trigger_run_now(request: Request, user=Depends(require_basic_auth)):
     """Manually trigger invoice processing."""
     try:
-        results = run_now()
+        # Run in a worker thread so the event loop keeps serving other requests
+        results = await asyncio.to_thread(run_now)
         message = (
             f"Verarbeitung abgeschlossen: {results['sent']} gesendet, "
             f"{results['skipped']} übersprungen, {results['failed']} fehlgeschlagen"
@@ -467,11 +480,11 @@ async def resend_log(
         return RedirectResponse(url=f"/logs?error=Lesefehler: {e}", status_code=302)
 
     try:
-        invoice_data = parse_invoice(BytesIO(pdf_bytes), filename=log_entry.filename)
+        invoice_data = parse_invoice(pdf_bytes, filename=log_entry.filename)
     except Exception as e:
         return RedirectResponse(url=f"/logs?error=Parsing fehlgeschlagen: {e}", status_code=302)
 
-    today = datetime.now(TIMEZONE).date()
+    today = get_today()
     email_template = settings.get(AppSettings.KEY_EMAIL_TEMPLATE, "")
     subject_template = log_entry.subject or log_entry.filename.replace(".pdf", "")
 
@@ -532,6 +545,19 @@ async def health_check():
     return {"status": "healthy", "timestamp": datetime.utcnow().isoformat()}
 
 
+@app.get("/api/db-pool")
+async def api_db_pool(user=Depends(require_basic_auth)):
+    """Get database connection pool usage (diagnostics, requires login)."""
+    try:
+        pool = get_pool_status()
+    except Exception as e:
+        logger.error(f"Pool status unavailable: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+    if pool["saturated"]:
+        logger.warning(f"Database pool overflow saturated: {pool['status']}")
+    return pool
+
+
 @app.get("/api/settings")
 async def get_api_settings(db: Session = Depends(get_db), user=Depends(require_basic_auth)):
     """Get current settings via API."""
@@ -557,14 +583,49 @@ async def get_api_logs(limit: int = 100, db: Session = Depends(get_db), user=Dep
     ]
 
 
-@app.post("/api/run")
-async def api_run_now(user=Depends(require_basic_auth)):
-    """Trigger invoice processing via API."""
+# Background processing jobs started via /api/run, keyed by job id
+_JOBS: dict = {}
+_JOB_TASKS: set = set()
+MAX_FINISHED_JOBS = 20
+
+
+def _run_and_store(job_id: str) -> None:
+    """Run invoice processing and record the outcome for polling."""
     try:
         results = run_now()
-        return {"status": "success", "results": results}
+        _JOBS[job_id] = {"status": "success", "results": results, "finished_at": datetime.utcnow().isoformat()}
     except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+        logger.error(f"Background run {job_id} failed: {e}")
+        _JOBS[job_id] = {"status": "error", "detail": str(e), "finished_at": datetime.utcnow().isoformat()}
+
+
+def _prune_finished_jobs() -> None:
+    """Keep only the most recent finished jobs in memory."""
+    finished = [job_id for job_id, job in _JOBS.items() if job["status"] != "running"]
+    for job_id in finished[:-MAX_FINISHED_JOBS]:
+        _JOBS.pop(job_id, None)
+
+
+@app.post("/api/run")
+async def api_run_now(user=Depends(require_basic_auth)):
+    """Trigger invoice processing via API in the background. Poll /api/run/{job_id} for the result."""
+    _prune_finished_jobs()
+    job_id = uuid4().hex
+    _JOBS[job_id] = {"status": "running", "started_at": datetime.utcnow().isoformat()}
+    task = asyncio.create_task(asyncio.to_thread(_run_and_store, job_id))
+    # Keep a reference so the task is not garbage collected while running
+    _JOB_TASKS.add(task)
+    task.add_done_callback(_JOB_TASKS.discard)
+    return {"status": "running", "job_id": job_id}
+
+
+@app.get("/api/run/{job_id}")
+async def api_run_status(job_id: str, user=Depends(require_basic_auth)):
+    """Get the state of a background processing job."""
+    job = _JOBS.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job nicht gefunden")
+    return {"job_id": job_id, **job}
 
 
 @app.post("/api/run-selected")
@@ -582,7 +643,8 @@ async def api_run_selected(
     selected = {os.path.basename(str(name)) for name in filenames}
 
     try:
-        results = run_now(dry_run=dry_run, selected_files=selected)
+        # Off the event loop: a real run waits for any daily/background run holding the lock
+        results = await asyncio.to_thread(run_now, dry_run=dry_run, selected_files=selected)
         return {"status": "success", "results": results}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -696,6 +758,7 @@ async def api_restore_db(file: UploadFile = File(...), user=Depends(require_basi
             except Exception:
                 pass
         tmp_path.replace(db_path)
+        invalidate_settings_cache()
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Wiederherstellung fehlgeschlagen: {e}")
     finally:
@@ -726,12 +789,13 @@ async def api_invoice_preview(db: Session = Depends(get_db), user=Depends(requir
         raise HTTPException(status_code=400, detail="Quellordner ist nicht konfiguriert.")
 
     try:
-        invoice_files = fs.list_files(source_folder, pattern="RE-*.pdf")
+        # Repeated previews of an unchanged folder are served from the listing cache
+        invoice_files = fs.list_files_cached(source_folder, pattern="RE-*.pdf")
     except Exception as e:
         logger.error(f"Preview: failed to list files in {source_folder}: {e}")
         raise HTTPException(status_code=500, detail=f"Fehler beim Auflisten des Quellordners: {e}")
 
-    today = datetime.now(TIMEZONE).date()
+    today = get_today()
     items = []
 
     for file_path in sorted(invoice_files):
@@ -746,7 +810,7 @@ async def api_invoice_preview(db: Session = Depends(get_db), user=Depends(requir
 
         try:
             pdf_bytes = fs.read_file(file_path)
-            invoice_data = parse_invoice(BytesIO(pdf_bytes), filename=filename)
+            invoice_data = parse_invoice(pdf_bytes, filename=filename)
 
             item["invoice_date"] = invoice_data.invoice_date_str
             item["recipient"] = invoice_data.recipient_email or ""
@@ -903,10 +967,10 @@ async def test_smb_connection(
         except Exception as e:
             return {"status": "error", "message": f"Anmeldung fehlgeschlagen: {e}"}
             
-        # Try to list root of share
+        # Probe the share root with a single metadata request (no directory enumeration)
         path = f"\\\\{host}\\{clean_share}"
         try:
-            smbclient.listdir(path)
+            smbclient.stat(path)
             return {"status": "success", "message": f"Verbindung zu \\\\{host}\\{clean_share} erfolgreich!"}
         except Exception as e:
             return {"status": "error", "message": f"Zugriff verweigert oder Fehler: {str(e)}"}
@@ -921,11 +985,44 @@ async def test_smb_connection(
 # Folder Browser API
 # ============================================================================
 
+# Number of directory entries fetched per worker-thread hop while streaming
+BROWSE_CHUNK_SIZE = 50
+
+
+def _take_chunk(entries: Iterator[Dict[str, Any]], size: int = BROWSE_CHUNK_SIZE) -> List[Dict[str, Any]]:
+    """Pull up to `size` entries from a (blocking) directory iterator."""
+    chunk = []
+    for entry in entries:
+        chunk.append(entry)
+        if len(chunk) >= size:
+            break
+    return chunk
+
+
+async def _browse_ndjson(header: dict, first_chunk: List[Dict[str, Any]], entries: Iterator[Dict[str, Any]]):
+    """
+    Yield the folder listing as NDJSON: one header line, then one line per directory.
+    Blocking filesystem iteration runs in a worker thread so the event loop stays free.
+    """
+    yield json.dumps(header) + "\n"
+    chunk = first_chunk
+    while chunk:
+        yield "".join(json.dumps(entry) + "\n" for entry in chunk)
+        if len(chunk) < BROWSE_CHUNK_SIZE:
+            return
+        try:
+            chunk = await asyncio.to_thread(_take_chunk, entries)
+        except Exception as e:
+            logger.error(f"FS List Error while streaming {header['current_path']}: {e}")
+            yield json.dumps({"error": f"Fehler beim Auflisten: {e}"}) + "\n"
+            return
+
+
 @app.get("/api/browse")
 async def browse_folders(path: str = "/", db: Session = Depends(get_db), user=Depends(require_basic_auth)):
     """
     Browse folders using the configured filesystem (Local or SMB).
-    Returns list of directories at the given path.
+    Streams NDJSON: a header line with current/parent path, then one line per directory.
     """
     try:
         settings = AppSettings.get_all_settings(db)
@@ -936,9 +1033,10 @@ async def browse_folders(path: str = "/", db: Session = Depends(get_db), user=De
             if any(path.startswith(fp) for fp in ['/proc', '/sys', '/dev', '/run']):
                 raise HTTPException(status_code=403, detail="Zugriff auf diesen Pfad nicht erlaubt")
         
-        # List directories
+        # Fetch the first chunk up front so access errors still map to HTTP status codes
+        entries = fs.iter_directories(path)
         try:
-            directories = fs.list_directories(path)
+            first_chunk = await asyncio.to_thread(_take_chunk, entries)
         except PermissionError as e:
             logger.error(f"FS List Permission Error: {e}")
             raise HTTPException(status_code=403, detail=str(e))
@@ -954,11 +1052,14 @@ async def browse_folders(path: str = "/", db: Session = Depends(get_db), user=De
             if parent_path == ".":
                 parent_path = "/"
         
-        return {
+        header = {
             "current_path": path,
             "parent_path": parent_path,
-            "directories": directories
         }
+        return StreamingResponse(
+            _browse_ndjson(header, first_chunk, entries),
+            media_type="application/x-ndjson"
+        )
         
     except HTTPException:
         raise
@@ -3,11 +3,15 @@ Database models for the PPV Rechnung application.
 Includes models for email logs and application settings.
 """
 
+import itertools
 import logging
+import re
+import threading
 from datetime import datetime
-from typing import Optional, List
+from typing import Optional, List, Dict, Tuple, FrozenSet, Iterable
 
-from sqlalchemy import Column, Integer, String, DateTime, Text, desc
+from sqlalchemy import Column, Integer, String, DateTime, Text, Index, bindparam, delete, select, event
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.orm import Session
 
 from app.database import Base
@@ -18,6 +22,45 @@ logger = logging.getLogger(__name__)
 # Maximum number of email logs to keep
 MAX_EMAIL_LOGS = 100
 
+# Filenames per IN (...) clause when looking up sent invoices (stays below SQLite's variable limit)
+SENT_LOOKUP_CHUNK_SIZE = 500
+
+# Prune old email logs only every N inserts (the daily job prunes as well)
+PRUNE_EVERY_N_INSERTS = 20
+_prune_counter = itertools.count(1)  # next() is atomic, safe for worker threads
+
+# Placeholder values from .env.example that must not be used as real credentials
+_PLACEHOLDER_RE = re.compile(r"your-.*-here")
+_PLACEHOLDER_MARKERS = ("your-tenant-id", "your-client-id")
+_PLACEHOLDER_VALUES = frozenset({"rechnung@ppv-web.de"})  # Default sender in example
+
+# In-process cache of the raw app_settings rows (key -> value).
+# Defaults are applied on read, so only DB writes need to invalidate it.
+_settings_cache: Optional[Dict[str, Optional[str]]] = None
+_settings_gen = 0
+_cache_lock = threading.Lock()
+
+
+def invalidate_settings_cache() -> None:
+    """Drop the cached settings so the next read reloads them from the database."""
+    global _settings_cache, _settings_gen
+    with _cache_lock:
+        _settings_cache = None
+        _settings_gen += 1
+
+
+def get_settings_generation() -> int:
+    """Get the settings generation; it changes whenever settings are written."""
+    return _settings_gen
+
+
+@event.listens_for(Session, "after_commit")
+@event.listens_for(Session, "after_rollback")
+def _invalidate_after_settings_write(session: Session) -> None:
+    """Invalidate again once a settings write is committed or rolled back."""
+    if session.info.pop("settings_dirty", False):
+        invalidate_settings_cache()
+
 
 class EmailLog(Base):
     """
@@ -25,9 +68,15 @@ class EmailLog(Base):
     Automatically prunes to keep only the last MAX_EMAIL_LOGS entries.
     """
     __tablename__ = "email_logs"
+    __table_args__ = (
+        # Serves ORDER BY timestamp (DESC for get_recent, read backwards for pruning)
+        Index("ix_email_logs_ts", "timestamp"),
+        # Serves per-status lookups ordered by time (metrics: last success/failure)
+        Index("ix_email_logs_status_ts", "status", "timestamp"),
+    )
     
     id = Column(Integer, primary_key=True, index=True)
-    timestamp = Column(DateTime, default=datetime.utcnow, nullable=False, index=True)
+    timestamp = Column(DateTime, default=datetime.utcnow, nullable=False)
     filename = Column(String(255), nullable=False)
     invoice_date = Column(String(20), nullable=False)
     recipient_email = Column(String(255), nullable=False)
@@ -49,7 +98,7 @@ class EmailLog(Base):
         status: str = "sent",
         error_message: Optional[str] = None
     ) -> "EmailLog":
-        """Create a new email log entry and prune old entries."""
+        """Create a new email log entry and periodically prune old entries."""
         log_entry = cls(
             filename=filename,
             invoice_date=invoice_date,
@@ -61,40 +110,72 @@ class EmailLog(Base):
         db.add(log_entry)
         db.flush()  # Get the ID
         
-        # Prune old entries to keep only MAX_EMAIL_LOGS
-        cls.prune_old_entries(db)
+        # Prune old entries to keep only MAX_EMAIL_LOGS (amortized over several inserts)
+        if next(_prune_counter) % PRUNE_EVERY_N_INSERTS == 0:
+            cls.prune_old_entries(db)
         
         return log_entry
     
+    @classmethod
+    def create_row(cls, db: Session, **fields) -> int:
+        """
+        Insert one email log entry with a Core INSERT and return its ID.
+        
+        Takes the same keyword arguments as create() but skips building an ORM
+        instance and the unit-of-work flush, for callers that only need the ID.
+        """
+        row = {"timestamp": datetime.utcnow(), "status": "sent", "error_message": None, **fields}
+        result = db.execute(_INSERT_EMAIL_LOG, row)
+        
+        if next(_prune_counter) % PRUNE_EVERY_N_INSERTS == 0:
+            cls.prune_old_entries(db)
+        
+        return result.inserted_primary_key[0]
+    
+    @classmethod
+    def create_many(cls, db: Session, entries: List[dict]) -> int:
+        """
+        Insert several email log entries with one executemany INSERT, then prune once.
+        
+        Each entry holds the keyword arguments of create(); a "timestamp" key keeps
+        the time the event happened instead of the time of the insert.
+        """
+        if not entries:
+            return 0
+        now = datetime.utcnow()
+        rows = [{"timestamp": now, "status": "sent", "error_message": None, **entry} for entry in entries]
+        db.execute(_INSERT_EMAIL_LOG, rows)
+        cls.prune_old_entries(db)
+        return len(rows)
+    
     @classmethod
     def prune_old_entries(cls, db: Session) -> int:
-        """Remove oldest entries to keep only MAX_EMAIL_LOGS."""
-        count = db.query(cls).count()
-        if count > MAX_EMAIL_LOGS:
-            # Get IDs of entries to delete
-            entries_to_delete = (
-                db.query(cls.id)
-                .order_by(cls.timestamp.asc())
-                .limit(count - MAX_EMAIL_LOGS)
-                .all()
+        """Remove oldest entries to keep only MAX_EMAIL_LOGS (single DELETE statement)."""
+        result = db.execute(_PRUNE_EMAIL_LOGS, execution_options={"synchronize_session": False})
+        deleted = result.rowcount or 0
+        if deleted:
+            logger.info(f"Pruned {deleted} old email log entries")
+        return deleted
+    
+    @classmethod
+    def get_sent_keys(cls, db: Session, filenames: Iterable[str]) -> FrozenSet[Tuple[str, str]]:
+        """Get (filename, recipient_email) of all successfully sent entries for the given filenames."""
+        names = list(filenames)
+        keys = set()
+        for start in range(0, len(names), SENT_LOOKUP_CHUNK_SIZE):
+            chunk = names[start:start + SENT_LOOKUP_CHUNK_SIZE]
+            keys.update(
+                db.execute(
+                    select(cls.filename, cls.recipient_email)
+                    .where(cls.filename.in_(chunk), cls.status == "sent")
+                ).tuples()
             )
-            ids_to_delete = [e.id for e in entries_to_delete]
-            
-            if ids_to_delete:
-                db.query(cls).filter(cls.id.in_(ids_to_delete)).delete(synchronize_session=False)
-                logger.info(f"Pruned {len(ids_to_delete)} old email log entries")
-                return len(ids_to_delete)
-        return 0
+        return frozenset(keys)
     
     @classmethod
     def get_recent(cls, db: Session, limit: int = 100) -> List["EmailLog"]:
         """Get the most recent email logs."""
-        return (
-            db.query(cls)
-            .order_by(desc(cls.timestamp))
-            .limit(limit)
-            .all()
-        )
+        return db.execute(_GET_RECENT_LOGS, {"n": limit}).scalars().all()
 
 
 class AppSettings(Base):
@@ -145,36 +226,82 @@ PPV Medien GmbH"""
     def __repr__(self):
         return f"<AppSettings(key='{self.key}', value='{self.value[:50] if self.value else None}...')>"
     
+    @classmethod
+    def _cached_values(cls, db: Session) -> Dict[str, Optional[str]]:
+        """Get all stored settings as a dict, loading them with a single query if not cached."""
+        global _settings_cache
+        cache = _settings_cache
+        if cache is not None:
+            return cache
+        
+        gen = _settings_gen
+        values = dict(db.execute(_LOAD_SETTINGS).all())
+        with _cache_lock:
+            # Don't store the result if a write invalidated the cache meanwhile
+            if gen == _settings_gen:
+                _settings_cache = values
+        return values
+    
+    @classmethod
+    def get_stored_values(cls, db: Session) -> Dict[str, Optional[str]]:
+        """Get the settings exactly as stored in the database (no defaults or .env fallbacks)."""
+        return dict(cls._cached_values(db))
+    
     @classmethod
     def get(cls, db: Session, key: str, default: Optional[str] = None) -> Optional[str]:
         """Get a setting value by key."""
-        setting = db.query(cls).filter(cls.key == key).first()
-        if setting:
-            return setting.value
+        values = cls._cached_values(db)
+        if key in values:
+            return values[key]
         return default
     
     @classmethod
-    def set(cls, db: Session, key: str, value: str) -> "AppSettings":
+    def _upsert(cls, db: Session, rows: List[dict]) -> None:
+        """Insert or update settings rows in a single INSERT ... ON CONFLICT statement."""
+        stmt = sqlite_insert(cls).values(rows)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[cls.key],
+            set_={"value": stmt.excluded.value, "updated_at": stmt.excluded.updated_at},
+        )
+        db.execute(stmt)
+        db.info["settings_dirty"] = True
+        invalidate_settings_cache()
+    
+    @classmethod
+    def set(cls, db: Session, key: str, value: str) -> None:
         """Set a setting value, creating or updating as needed."""
-        setting = db.query(cls).filter(cls.key == key).first()
-        if setting:
-            setting.value = value
-            setting.updated_at = datetime.utcnow()
-        else:
-            setting = cls(key=key, value=value)
-            db.add(setting)
-        db.flush()
-        return setting
+        cls._upsert(db, [{"key": key, "value": value, "updated_at": datetime.utcnow()}])
+    
+    @classmethod
+    def set_many(cls, db: Session, values: dict) -> None:
+        """Set multiple setting values at once."""
+        if not values:
+            return
+        now = datetime.utcnow()
+        cls._upsert(db, [{"key": k, "value": v, "updated_at": now} for k, v in values.items()])
     
     @classmethod
     def get_all_settings(cls, db: Session) -> dict:
         """Get all settings as a dictionary with defaults applied."""
+        return cls.get_bundle(db)[0]
+    
+    @classmethod
+    def get_bundle(cls, db: Session) -> Tuple[dict, dict]:
+        """
+        Get all settings and the Microsoft Graph settings in one go.
+        
+        Both dicts are built from the same settings snapshot (one query at most),
+        so callers needing both don't have to resolve the Graph settings twice.
+        
+        Returns:
+            Tuple of (all settings as in get_all_settings, get_microsoft_settings result)
+        """
         settings = get_settings()
         
         # Use helper method to filter placeholders for MS settings
         ms_settings = cls.get_microsoft_settings(db)
         
-        return {
+        app_settings = {
             cls.KEY_SOURCE_FOLDER: cls.get(db, cls.KEY_SOURCE_FOLDER, settings.default_source_folder),
             cls.KEY_TARGET_FOLDER: cls.get(db, cls.KEY_TARGET_FOLDER, settings.default_target_folder),
             cls.KEY_SEND_TIME: cls.get(db, cls.KEY_SEND_TIME, settings.default_send_time),
@@ -194,6 +321,7 @@ PPV Medien GmbH"""
             cls.KEY_CLIENT_SECRET: ms_settings['client_secret'],
             cls.KEY_SENDER_ADDRESS: ms_settings['sender_address'],
         }
+        return app_settings, ms_settings
     
     @classmethod
     def initialize_defaults(cls, db: Session) -> None:
@@ -211,13 +339,17 @@ PPV Medien GmbH"""
             # Don't initialize Microsoft settings from env - let user configure via GUI
         }
         
-        for key, value in defaults.items():
-            existing = db.query(cls).filter(cls.key == key).first()
-            if not existing:
-                db.add(cls(key=key, value=value))
-                logger.info(f"Initialized default setting: {key}")
+        stmt = (
+            sqlite_insert(cls)
+            .values([{"key": key, "value": value} for key, value in defaults.items()])
+            .on_conflict_do_nothing(index_elements=[cls.key])
+        )
+        result = db.execute(stmt)
+        if result.rowcount:
+            logger.info(f"Initialized {result.rowcount} default settings")
         
         db.commit()
+        invalidate_settings_cache()
     
     @classmethod
     def get_microsoft_settings(cls, db: Session) -> dict:
@@ -226,28 +358,24 @@ PPV Medien GmbH"""
         Filters out placeholder values from environment variables.
         """
         settings = get_settings()
+        # One lookup for all four keys (plain key/value tuples, no ORM objects)
+        stored = cls._cached_values(db)
         
         def get_valid_value(db_key, env_value):
             # Check DB value first
-            db_val = cls.get(db, db_key)
+            db_val = stored.get(db_key)
             if db_val and db_val.strip():
                 return db_val
             
             # Check environment value, ignoring placeholders
-            if env_value:
-                # Filter out standard placeholders
-                lower_val = env_value.lower()
-                if "your-" in lower_val and "-here" in lower_val:
-                    return ""
-                # Filter out likely unmodified placeholders
-                if "your-tenant-id" in lower_val or "your-client-id" in lower_val:
-                    return ""
-                if env_value == "rechnung@ppv-web.de":  # Default sender in example
-                    return ""
-                
-                return env_value
-            
-            return ""
+            if not env_value:
+                return ""
+            if env_value in _PLACEHOLDER_VALUES:
+                return ""
+            lower_val = env_value.lower()
+            if _PLACEHOLDER_RE.search(lower_val) or any(m in lower_val for m in _PLACEHOLDER_MARKERS):
+                return ""
+            return env_value
 
         return {
             'tenant_id': get_valid_value(cls.KEY_TENANT_ID, settings.tenant_id),
@@ -263,3 +391,22 @@ PPV Medien GmbH"""
             "username": cls.get(db, cls.KEY_ADMIN_USER, "") or "",
             "password_hash": cls.get(db, cls.KEY_ADMIN_PASSWORD_HASH, "") or "",
         }
+
+
+# Statements for the hot queries, built once at import so each call skips
+# expression construction and hits SQLAlchemy's compiled cache directly.
+_GET_RECENT_LOGS = (
+    select(EmailLog)
+    .order_by(EmailLog.timestamp.desc())
+    .limit(bindparam("n"))
+)
+_PRUNE_EMAIL_LOGS = delete(EmailLog).where(
+    ~EmailLog.id.in_(
+        select(EmailLog.id)
+        .order_by(EmailLog.timestamp.desc())
+        .limit(MAX_EMAIL_LOGS)
+    )
+)
+_LOAD_SETTINGS = select(AppSettings.key, AppSettings.value)
+# Core (table-level) insert: plain executemany, no ORM bulk-insert bookkeeping
+_INSERT_EMAIL_LOG = EmailLog.__table__.insert()
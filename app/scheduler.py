@@ -4,37 +4,77 @@ Handles daily scheduled invoice processing and manual triggers.
 """
 
 import logging
+import re
 import shutil
+import string
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import nullcontext
 from datetime import date, datetime
+from functools import lru_cache, partial
 from pathlib import Path
-from typing import Optional, Callable, Set
-from io import BytesIO
+from typing import TYPE_CHECKING, Optional, Callable, FrozenSet, Set, Tuple
+from zoneinfo import ZoneInfo
 
-import pytz
 from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.triggers.cron import CronTrigger
 from apscheduler.jobstores.base import JobLookupError
 
 from app.config import get_settings
 from app.database import get_db_session
-from app.models import AppSettings, EmailLog
+from app.models import AppSettings, EmailLog, get_settings_generation
 from app.filesystem import get_filesystem, FileSystemProvider
-from app.invoice_parser import (
-    parse_invoice,
-    ZUGFeRDParseError,
-    InvoiceData
-)
-from app.mail_service import GraphMailService, GraphMailError
+
+# The PDF parser (pikepdf, lxml) and the Graph client (msal, requests) are only
+# needed while invoices are processed, so they are imported there; code that just
+# manages the schedule (e.g. get_next_run_time) doesn't pay for loading them.
+if TYPE_CHECKING:
+    from app.invoice_parser import InvoiceData
+    from app.mail_service import GraphMailService
 
 logger = logging.getLogger(__name__)
 
 # Timezone for scheduling
-TIMEZONE = pytz.timezone('Europe/Berlin')
+TIMEZONE = ZoneInfo('Europe/Berlin')
 
 # Job ID for the daily invoice processing job
 DAILY_JOB_ID = "daily_invoice_processing"
 
+# After downtime, run a missed daily job once (within an hour) instead of
+# replaying every missed fire time, and never overlap two runs
+DAILY_JOB_OPTIONS = {"coalesce": True, "misfire_grace_time": 3600, "max_instances": 1}
+
+# Fallback for the number of invoices processed concurrently (read, parse, send
+# and move are I/O bound); overridable via MAX_PARALLEL_INVOICES in .env
+MAX_PARALLEL_INVOICES = 8
+
+
+# Invoice files named RE-YYYYMMDD-*.pdf or RE-YYYY-MM-DD-*.pdf (also with "_" after
+# RE) carry their invoice date in the name; the backreference keeps separators consistent
+_FILENAME_DATE_RE = re.compile(r"^RE[-_](\d{4})(-?)(\d{2})\2(\d{2})(?=[-_.])")
+
+
+def get_today() -> date:
+    """Get today's date in the scheduling timezone (Europe/Berlin)."""
+    return datetime.now(TIMEZONE).date()
+
+
+def _filename_date_hint(filename: str) -> Optional[date]:
+    """
+    Get the invoice date encoded in a filename like RE-20250115-123.pdf or RE-2025-01-15-1.pdf.
+    
+    Returns None for other naming schemes (e.g. RE-2025-12345.pdf), in which
+    case the date has to be read from the embedded XML.
+    """
+    match = _FILENAME_DATE_RE.match(filename)
+    if not match:
+        return None
+    try:
+        return date(int(match.group(1)), int(match.group(3)), int(match.group(4)))
+    except ValueError:
+        return None
+
 
 class _SafeDict(dict):
     """Dict that returns empty string for missing keys to simplify template formatting."""
@@ -42,18 +82,63 @@ class _SafeDict(dict):
         return ""
 
 
-def render_email_template(template: str, invoice_data: InvoiceData, filename: str, today: date) -> str:
+# A "{{", "}}", a complete "{field}" or a lone brace, in that order of preference
+_TEMPLATE_TOKEN_RE = re.compile(r"\{\{|\}\}|\{([^{}]*)\}|[{}]")
+
+
+def _is_simple_field(field: str) -> bool:
+    """Check whether a replacement field is a plain {name} or {name:spec} valid for strings."""
+    name, _, format_spec = field.partition(":")
+    if not name.isidentifier():
+        return False
+    if format_spec:
+        try:
+            format("", format_spec)
+        except ValueError:
+            return False
+    return True
+
+
+def validate_template(template: str) -> str:
     """
-    Render the email template with available invoice placeholders.
+    Sanitize a subject/body template so it always renders with str.format_map.
     
-    Supported placeholders:
-        {invoice_number}, {buyer_name}, {invoice_date}, {invoice_date_iso},
-        {recipient_email}, {filename}, {today}
+    Keeps {placeholder} and {placeholder:spec} fields and escaped braces; any
+    other brace (stray, positional, attribute or conversion fields) is doubled
+    and therefore rendered literally.
     """
     if not template:
-        return ""
+        return template
+
+    def escape(match: "re.Match") -> str:
+        token = match.group(0)
+        if token in ("{{", "}}"):
+            return token
+        field = match.group(1)
+        if field is not None and _is_simple_field(field):
+            return token
+        return token.replace("{", "{{").replace("}", "}}")
+
+    return _TEMPLATE_TOKEN_RE.sub(escape, template)
+
+
+@lru_cache(maxsize=32)
+def _compile_template(template: str) -> Tuple[Tuple[str, Optional[str], str], ...]:
+    """
+    Split a template into (literal_text, field_name, format_spec) fragments, once per distinct template.
+    
+    The template is sanitized first, so values stored before validation existed
+    and subjects taken from file names render the same way.
+    """
+    return tuple(
+        (literal, field_name, format_spec or "")
+        for literal, field_name, format_spec, _ in string.Formatter().parse(validate_template(template))
+    )
+
 
-    values = _SafeDict({
+def template_values(invoice_data: "InvoiceData", filename: str, today: date) -> _SafeDict:
+    """Build the placeholder values for one invoice (shared by subject and body)."""
+    return _SafeDict({
         "invoice_number": invoice_data.invoice_number or "",
         "buyer_name": invoice_data.buyer_name or "",
         "invoice_date": invoice_data.invoice_date_str or "",
@@ -63,14 +148,29 @@ def render_email_template(template: str, invoice_data: InvoiceData, filename: st
         "today": today.isoformat(),
     })
 
-    try:
-        return template.format_map(values)
-    except Exception:
-        # If format fails (e.g., stray braces), fall back to simple replace for known keys
-        rendered = template
-        for key, val in values.items():
-            rendered = rendered.replace(f"{{{key}}}", str(val))
-        return rendered
+
+def render_template(template: str, values: _SafeDict) -> str:
+    """Render a template with precomputed placeholder values (see template_values)."""
+    if not template:
+        return ""
+
+    return "".join(
+        literal if name is None else literal + (format(values[name], spec) if spec else values[name])
+        for literal, name, spec in _compile_template(template)
+    )
+
+
+def render_email_template(template: str, invoice_data: "InvoiceData", filename: str, today: date) -> str:
+    """
+    Render the email template with available invoice placeholders.
+    
+    Supported placeholders:
+        {invoice_number}, {buyer_name}, {invoice_date}, {invoice_date_iso},
+        {recipient_email}, {filename}, {today}
+    """
+    if not template:
+        return ""
+    return render_template(template, template_values(invoice_data, filename, today))
 
 
 class InvoiceProcessor:
@@ -78,9 +178,6 @@ class InvoiceProcessor:
     Processes invoice PDFs: parses, sends emails, and moves files.
     """
     
-    def __init__(self):
-        self.settings = get_settings()
-    
     def process_invoices(
         self,
         force_send: bool = False,
@@ -111,128 +208,220 @@ class InvoiceProcessor:
             "errors": [],
         }
         error_summary = {}
+        error_lock = threading.Lock()
 
         def record_error(key: str):
-            error_summary[key] = error_summary.get(key, 0) + 1
+            with error_lock:
+                error_summary[key] = error_summary.get(key, 0) + 1
+        
+        # Failure log entries are collected and written in one batch after the run;
+        # "sent" entries are still committed immediately for duplicate protection
+        pending_logs = []
+        
+        def record_log(**fields):
+            fields["timestamp"] = datetime.utcnow()
+            with error_lock:
+                pending_logs.append(fields)
         
+        # Read settings in a short-lived session; invoices get their own sessions below
         with get_db_session() as db:
-            # Get current settings
-            app_settings = AppSettings.get_all_settings(db)
-            
-            # Use filesystem abstraction
-            fs = get_filesystem(app_settings)
-            
-            source_folder = app_settings[AppSettings.KEY_SOURCE_FOLDER]
-            target_folder = app_settings[AppSettings.KEY_TARGET_FOLDER]
-            email_template = app_settings[AppSettings.KEY_EMAIL_TEMPLATE]
-            send_past_dates = str(app_settings.get(AppSettings.KEY_SEND_PAST_DATES, "false")).lower() == "true"
-            ms_settings = AppSettings.get_microsoft_settings(db)
-            mail_service = None
-            mail_init_error: Optional[Exception] = None
-
-            if not dry_run:
-                if not (ms_settings["tenant_id"] and ms_settings["client_id"] and ms_settings["client_secret"] and ms_settings["sender_address"]):
-                    mail_init_error = GraphMailError(
-                        "Microsoft Graph credentials are not configured. "
-                        "Please configure Tenant ID, Client ID, Client Secret und Absenderadresse in den Einstellungen."
-                    )
-                    logger.error(mail_init_error)
-                else:
-                    try:
-                        mail_service = GraphMailService(
-                            tenant_id=ms_settings["tenant_id"],
-                            client_id=ms_settings["client_id"],
-                            client_secret=ms_settings["client_secret"],
-                            sender_address=ms_settings["sender_address"],
-                        )
-                    except Exception as e:
-                        mail_init_error = e
-                        logger.error(f"Failed to initialize mail service: {e}")
-
-            # Ensure target folder exists
-            try:
-                if not fs.exists(target_folder):
-                    fs.create_directory(target_folder)
-            except Exception as e:
-                logger.error(f"Failed to create target folder {target_folder}: {e}")
-                return results
-            
-            # Find invoice files
-            try:
-                invoice_files = fs.list_files(source_folder, pattern="RE-*.pdf")
-            except Exception as e:
-                logger.error(f"Failed to list files in {source_folder}: {e}")
-                return results
-            
-            if not invoice_files:
-                logger.info(f"No invoice files found in {source_folder}")
-                return results
-            
-            logger.info(f"Found {len(invoice_files)} invoice files to process")
-            
-            # Get today's date in Berlin timezone
-            today = datetime.now(TIMEZONE).date()
-            logger.info(f"Today's date (Europe/Berlin): {today}")
-            
-            for file_path in invoice_files:
+            app_settings, ms_settings = AppSettings.get_bundle(db)
+        
+        # Use filesystem abstraction
+        fs = get_filesystem(app_settings)
+        
+        source_folder = app_settings[AppSettings.KEY_SOURCE_FOLDER]
+        send_past_dates = str(app_settings.get(AppSettings.KEY_SEND_PAST_DATES, "false")).lower() == "true"
+        
+        # List the source folder first: on most days there is nothing to do, and
+        # then neither the target folder nor the Graph client is touched.
+        # Files are streamed; only the selected ones are kept.
+        pending = []
+        try:
+            for file_path in fs.iter_files(source_folder, pattern="RE-*.pdf"):
                 filename = os.path.basename(file_path)
 
                 if selected_files is not None and filename not in selected_files:
                     continue
 
-                results["processed"] += 1
-                
+                # Split the name once; subject, logs and the move all reuse the parts
+                stem, ext = os.path.splitext(filename)
+                pending.append((file_path, filename, stem, ext))
+        except Exception as e:
+            logger.error(f"Failed to list files in {source_folder}: {e}")
+            return results
+        
+        if not pending:
+            logger.info(f"No invoice files found in {source_folder}")
+            return results
+        
+        logger.info(f"Found {len(pending)} invoice files to process")
+        
+        # Get today's date in Berlin timezone
+        today = get_today()
+        logger.info(f"Today's date (Europe/Berlin): {today}")
+        
+        results["processed"] = len(pending)
+        
+        # Date rule for this run, built once and shared read-only by all workers
+        def skip_reason(invoice_date: Optional[date]) -> Optional[str]:
+            """Return why an invoice with this date is not sent today, or None if it is due."""
+            if force_send:
+                return None
+            if invoice_date is None:
+                return "no invoice date"
+            # Only send if date is today or (optionally) in the past; always skip future unless force_send
+            if invoice_date > today:
+                return f"invoice date {invoice_date} is in the future"
+            if not send_past_dates and invoice_date != today:
+                return f"invoice date {invoice_date} != today {today} and past sending disabled"
+            return None
+        
+        # Opt-in: skip files whose name already rules out sending today, without reading
+        # them. The filename date is not checked against the XML, so this is off by default.
+        if not force_send and get_settings().filename_date_prefilter:
+            remaining = []
+            for entry in pending:
+                filename = entry[1]
+                hint = _filename_date_hint(filename)
+                reason = skip_reason(hint) if hint is not None else None
+                if reason:
+                    logger.warning(f"Filename date of {filename}: {reason}, skipping without reading the PDF")
+                    results["skipped"] += 1
+                    continue
+                remaining.append(entry)
+            pending = remaining
+        
+        if not pending:
+            results["error_summary"] = error_summary
+            logger.info(f"Invoice processing complete: {results['skipped']} skipped by filename date")
+            return results
+        
+        # Everything below is only needed when there is something to send
+        from app.mail_service import GraphMailError, get_mail_service
+        
+        target_folder = app_settings[AppSettings.KEY_TARGET_FOLDER]
+        email_template = app_settings[AppSettings.KEY_EMAIL_TEMPLATE]
+        mail_service = None
+        mail_init_error: Optional[Exception] = None
+
+        if not dry_run:
+            if not (ms_settings["tenant_id"] and ms_settings["client_id"] and ms_settings["client_secret"] and ms_settings["sender_address"]):
+                mail_init_error = GraphMailError(
+                    "Microsoft Graph credentials are not configured. "
+                    "Please configure Tenant ID, Client ID, Client Secret und Absenderadresse in den Einstellungen."
+                )
+                logger.error(mail_init_error)
+            else:
                 try:
-                    result = self._process_single_invoice(
-                        db=db,
-                        fs=fs,
-                        file_path=file_path,
-                        filename=filename,
-                        target_folder=target_folder,
-                        email_template=email_template,
-                        today=today,
-                        force_send=force_send,
-                        send_past_dates=send_past_dates,
-                        dry_run=dry_run,
-                        allow_resend=allow_resend,
-                        mail_service=mail_service,
-                        mail_init_error=mail_init_error,
-                        record_error=record_error,
+                    # Reuses the service (and its token) from earlier runs if credentials are unchanged
+                    mail_service = get_mail_service(
+                        tenant_id=ms_settings["tenant_id"],
+                        client_id=ms_settings["client_id"],
+                        client_secret=ms_settings["client_secret"],
+                        sender_address=ms_settings["sender_address"],
                     )
-                    
-                    if result == "sent":
-                        results["sent"] += 1
-                        results["would_send"] += 1
-                    elif result == "dry_send":
-                        results["would_send"] += 1
-                    elif result == "skipped":
-                        results["skipped"] += 1
-                    elif result == "failed":
-                        results["failed"] += 1
-                        
                 except Exception as e:
-                    logger.exception(f"Unexpected error processing {filename}: {e}")
+                    mail_init_error = e
+                    logger.error(f"Failed to initialize mail service: {e}")
+
+        # Ensure target folder exists
+        try:
+            if not fs.exists(target_folder):
+                fs.create_directory(target_folder)
+        except Exception as e:
+            logger.error(f"Failed to create target folder {target_folder}: {e}")
+            return results
+        
+        # Previously sent invoices, looked up once for all pending files (runs are
+        # serialized, so no other run can add entries for these files meanwhile)
+        sent_keys: FrozenSet[Tuple[str, str]] = frozenset()
+        if not allow_resend:
+            with get_db_session() as db:
+                sent_keys = EmailLog.get_sent_keys(db, (entry[1] for entry in pending))
+        
+        # Fetch the token once before fanning out, so workers don't race for it
+        if mail_service is not None:
+            try:
+                mail_service.ensure_token()
+            except Exception as e:
+                mail_init_error = e
+                mail_service = None
+                logger.error(f"Failed to acquire Microsoft Graph access token: {e}")
+        
+        # Each task uses its own short DB sessions; counters are only updated here
+        jobs = [
+            (filename, stem, partial(
+                self._process_single_invoice,
+                fs=fs,
+                file_path=file_path,
+                filename=filename,
+                stem=stem,
+                ext=ext,
+                target_folder=target_folder,
+                email_template=email_template,
+                today=today,
+                skip_reason=skip_reason,
+                dry_run=dry_run,
+                allow_resend=allow_resend,
+                mail_service=mail_service,
+                mail_init_error=mail_init_error,
+                record_error=record_error,
+                record_log=record_log,
+                sent_keys=sent_keys,
+            ))
+            for file_path, filename, stem, ext in pending
+        ]
+        
+        def collect(filename: str, stem: str, get_result: Callable[[], Tuple[str, Optional[str]]]):
+            try:
+                result, error_msg = get_result()
+                if error_msg:
+                    results["errors"].append(f"{filename}: {error_msg}")
+                
+                if result == "sent":
+                    results["sent"] += 1
+                    results["would_send"] += 1
+                elif result == "dry_send":
+                    results["would_send"] += 1
+                elif result == "skipped":
+                    results["skipped"] += 1
+                elif result == "failed":
                     results["failed"] += 1
-                    results["errors"].append(f"{filename}: {str(e)}")
-                    record_error("unexpected")
-                    if not dry_run:
-                        try:
-                            EmailLog.create(
-                                db=db,
-                                filename=filename,
-                                invoice_date="",
-                                recipient_email="",
-                                subject=filename.replace(".pdf", ""),
-                                status="failed",
-                                error_message=f"Unerwarteter Fehler ({type(e).__name__}): {e}"
-                            )
-                        except Exception as log_err:
-                            logger.error(f"Could not record failure for {filename}: {log_err}")
-            
-            if dry_run:
-                db.rollback()
-            else:
-                db.commit()
+                    
+            except Exception as e:
+                logger.exception(f"Unexpected error processing {filename}: {e}")
+                results["failed"] += 1
+                results["errors"].append(f"{filename}: {str(e)}")
+                record_error("unexpected")
+                if not dry_run:
+                    record_log(
+                        filename=filename,
+                        invoice_date="",
+                        recipient_email="",
+                        subject=stem,
+                        status="failed",
+                        error_message=f"Unerwarteter Fehler ({type(e).__name__}): {e}"
+                    )
+        
+        if len(jobs) == 1:
+            # A single file (e.g. one selected in the UI) doesn't need a thread pool
+            collect(*jobs[0])
+        else:
+            max_workers = get_settings().max_parallel_invoices or MAX_PARALLEL_INVOICES
+            workers = max(1, min(max_workers, len(jobs)))
+            with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="invoice") as executor:
+                futures = {executor.submit(job): (filename, stem) for filename, stem, job in jobs}
+                for future in as_completed(futures):
+                    filename, stem = futures[future]
+                    collect(filename, stem, future.result)
+        
+        if pending_logs:
+            try:
+                with get_db_session() as db:
+                    EmailLog.create_many(db, pending_logs)
+            except Exception as e:
+                logger.error(f"Could not write {len(pending_logs)} failure log entries: {e}")
         
         results["error_summary"] = error_summary
 
@@ -247,31 +436,52 @@ class InvoiceProcessor:
         
         return results
     
+    @staticmethod
+    def _write_log(**fields) -> int:
+        """Write one email log entry in its own short transaction and return its ID."""
+        with get_db_session() as db:
+            return EmailLog.create_row(db, **fields)
+    
+    @staticmethod
+    def _annotate_log(log_id: int, error_message: str) -> None:
+        """Attach an error message to an already committed email log entry."""
+        with get_db_session() as db:
+            db.query(EmailLog).filter(EmailLog.id == log_id).update(
+                {"error_message": error_message}, synchronize_session=False
+            )
+    
     def _process_single_invoice(
         self,
-        db,
         fs: FileSystemProvider,
         file_path: str,
         filename: str,
+        stem: str,
+        ext: str,
         target_folder: str,
         email_template: str,
         today: date,
-        force_send: bool,
-        send_past_dates: bool,
+        skip_reason: Callable[[Optional[date]], Optional[str]],
         dry_run: bool,
         allow_resend: bool,
-        mail_service: Optional[GraphMailService],
+        mail_service: Optional["GraphMailService"],
         mail_init_error: Optional[Exception],
         record_error: Optional[Callable[[str], None]],
-    ) -> str:
+        record_log: Callable[..., None],
+        sent_keys: FrozenSet[Tuple[str, str]] = frozenset(),
+    ) -> Tuple[str, Optional[str]]:
         """
         Process a single invoice PDF.
         
         Returns:
-            "sent", "skipped", "dry_send", or "failed"
+            Tuple of (status, error_msg): status is "sent", "skipped", "dry_send" or
+            "failed"; error_msg describes a problem the status doesn't show
+            (e.g. a sent invoice that couldn't be moved), otherwise None.
         """
+        from app.invoice_parser import parse_invoice, ZUGFeRDParseError
+        from app.mail_service import GraphMailError
+        
         logger.info(f"Processing invoice: {filename}")
-        subject_text = filename.replace(".pdf", "")
+        subject_text = stem
 
         def mark_error(key: str):
             if record_error:
@@ -284,8 +494,7 @@ class InvoiceProcessor:
             logger.error(f"Failed to read file {filename}: {e}")
             mark_error("read_error")
             if not dry_run:
-                EmailLog.create(
-                    db=db,
+                record_log(
                     filename=filename,
                     invoice_date="",
                     recipient_email="",
@@ -293,33 +502,31 @@ class InvoiceProcessor:
                     status="failed",
                     error_message=f"Datei konnte nicht gelesen werden: {e}"
                 )
-            return "failed"
+            return "failed", None
             
         # Parse the invoice
         try:
-            invoice_data = parse_invoice(BytesIO(pdf_content), filename=filename)
+            invoice_data = parse_invoice(pdf_content, filename=filename)
         except ZUGFeRDParseError as e:
             logger.error(f"Failed to parse invoice {filename}: {e}")
             mark_error("parse_error")
             if not dry_run:
-                EmailLog.create(
-                    db=db,
+                record_log(
                     filename=filename,
                     invoice_date="",
                     recipient_email="",
-                    subject=filename.replace(".pdf", ""),
+                    subject=stem,
                     status="failed",
                     error_message=f"Parse error: {e}"
                 )
-            return "failed"
+            return "failed", None
         
         # Check if we have required data
         if not invoice_data.recipient_email:
             logger.warning(f"No recipient email found in {filename}")
             mark_error("missing_recipient")
             if not dry_run:
-                EmailLog.create(
-                    db=db,
+                record_log(
                     filename=filename,
                     invoice_date=invoice_data.invoice_date_str,
                     recipient_email="",
@@ -327,56 +534,39 @@ class InvoiceProcessor:
                     status="failed",
                     error_message="No recipient email found in invoice"
                 )
-            return "failed"
+            return "failed", None
 
         # Duplicate protection unless explicitly allowed
         if not allow_resend:
-            already_sent = (
-                db.query(EmailLog)
-                .filter(
-                    EmailLog.filename == filename,
-                    EmailLog.recipient_email == invoice_data.recipient_email,
-                    EmailLog.status == "sent"
-                )
-                .first()
-            )
-            if already_sent:
+            if (filename, invoice_data.recipient_email) in sent_keys:
                 logger.info(f"Invoice {filename} already sent to {invoice_data.recipient_email}, skipping")
-                return "skipped"
+                return "skipped", None
         
-        # Check invoice date (skip if not today, unless force_send)
-        if not force_send:
+        # Check invoice date (skip if not due today, unless force_send)
+        reason = skip_reason(invoice_data.invoice_date)
+        if reason:
             if invoice_data.invoice_date is None:
+                # A missing date is a data problem, not just an invoice that isn't due yet
                 logger.warning(f"No invoice date found in {filename}, skipping")
-                return "skipped"
-            
-            # Only send if date is today or (optionally) in the past; always skip future unless force_send
-            if invoice_data.invoice_date > today:
-                logger.info(
-                    f"Invoice date {invoice_data.invoice_date} is in the future, skipping {filename}"
-                )
-                return "skipped"
-            if not send_past_dates and invoice_data.invoice_date != today:
-                logger.info(
-                    f"Invoice date {invoice_data.invoice_date} != today {today} and past sending disabled, skipping {filename}"
-                )
-                return "skipped"
+            else:
+                logger.info(f"Skipping {filename}: {reason}")
+            return "skipped", None
 
         # Render subject/body placeholders
-        subject_text = render_email_template(subject_text, invoice_data, filename, today)
-        email_body = render_email_template(email_template, invoice_data, filename, today)
+        values = template_values(invoice_data, filename, today)
+        subject_text = render_template(subject_text, values)
+        email_body = render_template(email_template, values)
 
         # Dry run: report what would happen without side effects
         if dry_run:
             logger.info(f"Dry run: would send {filename} to {invoice_data.recipient_email}")
-            return "dry_send"
+            return "dry_send", None
         
         # Get mail service with current DB settings
         if mail_init_error is not None:
             logger.error(f"Mail service unavailable for {filename}: {mail_init_error}")
             mark_error("mail_service_init")
-            EmailLog.create(
-                db=db,
+            record_log(
                 filename=filename,
                 invoice_date=invoice_data.invoice_date_str,
                 recipient_email=invoice_data.recipient_email,
@@ -384,7 +574,7 @@ class InvoiceProcessor:
                 status="failed",
                 error_message=f"Send error: {mail_init_error}"
             )
-            return "failed"
+            return "failed", None
         
         # Send the email
         try:
@@ -398,8 +588,7 @@ class InvoiceProcessor:
         except GraphMailError as e:
             logger.error(f"Failed to send email for {filename}: {e}")
             mark_error("send_graph_error")
-            EmailLog.create(
-                db=db,
+            record_log(
                 filename=filename,
                 invoice_date=invoice_data.invoice_date_str,
                 recipient_email=invoice_data.recipient_email,
@@ -407,13 +596,12 @@ class InvoiceProcessor:
                 status="failed",
                 error_message=f"Send error: {e}"
             )
-            return "failed"
+            return "failed", None
         except Exception as e:
             # Catch-all to surface unexpected errors with stack trace
             logger.exception(f"Unexpected send error for {filename}: {e}")
             mark_error("send_unexpected_error")
-            EmailLog.create(
-                db=db,
+            record_log(
                 filename=filename,
                 invoice_date=invoice_data.invoice_date_str,
                 recipient_email=invoice_data.recipient_email,
@@ -421,11 +609,10 @@ class InvoiceProcessor:
                 status="failed",
                 error_message=f"Unerwarteter Send-Fehler ({type(e).__name__}): {e}"
             )
-            return "failed"
+            return "failed", None
         
-        # Log successful send
-        log_entry = EmailLog.create(
-            db=db,
+        # Log successful send (committed right away, independent of the file move)
+        log_id = self._write_log(
             filename=filename,
             invoice_date=invoice_data.invoice_date_str,
             recipient_email=invoice_data.recipient_email,
@@ -439,40 +626,42 @@ class InvoiceProcessor:
             # We use join_path from fs to handle correct separators
             target_path = fs.join_path(target_folder, filename)
             
-            # Check for duplicates? fs.exists might work if path is correct
-            # Handling duplicates on SMB without full path manipulation libraries is simpler by just overwriting 
-            # or we can check existence.
-            if fs.exists(target_path):
-                # Simple rename strategy: append timestamp
-                base, ext = os.path.splitext(filename)
+            try:
+                fs.move_file(file_path, target_path, overwrite=False)
+            except FileExistsError:
+                # Name already taken in the target folder: keep both, append a timestamp
                 ts = datetime.now().strftime("%Y%m%d_%H%M%S")
-                new_filename = f"{base}_{ts}{ext}"
-                target_path = fs.join_path(target_folder, new_filename)
-            
-            fs.move_file(file_path, target_path)
+                target_path = fs.join_path(target_folder, f"{stem}_{ts}{ext}")
+                fs.move_file(file_path, target_path, overwrite=False)
             logger.info(f"Moved {filename} to {target_path}")
             
         except Exception as e:
             logger.error(f"Failed to move {filename} to target folder: {e}")
             # Don't fail the whole operation, email was sent successfully
-            # Note: We cannot access 'results' here as it's not passed to this method.
-            # Instead we return a special status or just log it and rely on the return value.
+            move_error = f"Datei nicht verschoben: {e}"
             
-            # Mark log entry as failed so UI and summary reflect the move problem
-            if log_entry:
-                log_entry.status = "sent"
-                log_entry.error_message = f"Datei nicht verschoben: {e}"
+            # Keep the log entry as sent but record the move problem for the UI
+            try:
+                self._annotate_log(log_id, move_error)
+            except Exception as log_err:
+                logger.error(f"Could not record move failure for {filename}: {log_err}")
             
-            # Since email was sent, treat it as sent but keep the warning in the log
-            return "sent"
+            # Since email was sent, treat it as sent and let the caller report the warning
+            return "sent", move_error
         
-        return "sent"
+        return "sent", None
 
 
 # Global scheduler instance
 _scheduler: Optional[BackgroundScheduler] = None
 _processor: Optional[InvoiceProcessor] = None
 
+# Serializes runs that send and move files (daily job and manual "run now")
+_run_lock = threading.Lock()
+
+# Parsed daily send time, valid for one settings generation
+_send_time_cache = {"version": -1, "hour": 9, "minute": 0}
+
 
 def get_processor() -> InvoiceProcessor:
     """Get or create the global invoice processor instance."""
@@ -495,39 +684,64 @@ def scheduled_job():
     logger.info("Scheduled invoice processing triggered")
     try:
         processor = get_processor()
-        results = processor.process_invoices(force_send=False)
+        with _run_lock:
+            results = processor.process_invoices(force_send=False)
         logger.info(f"Scheduled processing results: {results}")
     except Exception as e:
         logger.error(f"Scheduled processing failed: {e}")
 
+    # Catch up on log pruning skipped between inserts
+    try:
+        with get_db_session() as db:
+            EmailLog.prune_old_entries(db)
+    except Exception as e:
+        logger.error(f"Email log pruning failed: {e}")
+
 
-def start_scheduler():
-    """Start the scheduler with the configured daily time."""
-    scheduler = get_scheduler()
+def get_send_time() -> Tuple[int, int]:
+    """
+    Get the configured daily send time as (hour, minute).
     
-    if scheduler.running:
-        logger.info("Scheduler already running")
-        return
+    The parsed value is kept until the settings generation changes, so only the
+    first call after a settings write reads the database.
+    """
+    global _send_time_cache
+    cache = _send_time_cache
+    version = get_settings_generation()
+    if cache["version"] == version:
+        return cache["hour"], cache["minute"]
     
-    # Get the configured send time
     with get_db_session() as db:
-        app_settings = AppSettings.get_all_settings(db)
-        send_time = app_settings[AppSettings.KEY_SEND_TIME]
-    
-    # Parse time
+        send_time = AppSettings.get_all_settings(db)[AppSettings.KEY_SEND_TIME]
     try:
         hour, minute = map(int, send_time.split(':'))
     except ValueError:
         logger.warning(f"Invalid send time '{send_time}', using default 09:00")
         hour, minute = 9, 0
     
+    # Stored under the generation read before loading: a write in between forces a reload
+    _send_time_cache = {"version": version, "hour": hour, "minute": minute}
+    return hour, minute
+
+
+def start_scheduler():
+    """Start the scheduler with the configured daily time."""
+    scheduler = get_scheduler()
+    
+    if scheduler.running:
+        logger.info("Scheduler already running")
+        return
+    
+    hour, minute = get_send_time()
+    
     # Add the daily job
     scheduler.add_job(
         scheduled_job,
         trigger=CronTrigger(hour=hour, minute=minute, timezone=TIMEZONE),
         id=DAILY_JOB_ID,
         replace_existing=True,
-        name="Daily Invoice Processing"
+        name="Daily Invoice Processing",
+        **DAILY_JOB_OPTIONS
     )
     
     scheduler.start()
@@ -574,7 +788,8 @@ def reschedule_daily_job(send_time: str):
         trigger=CronTrigger(hour=hour, minute=minute, timezone=TIMEZONE),
         id=DAILY_JOB_ID,
         replace_existing=True,
-        name="Daily Invoice Processing"
+        name="Daily Invoice Processing",
+        **DAILY_JOB_OPTIONS
     )
     
     logger.info(f"Rescheduled daily job to {hour:02d}:{minute:02d} Europe/Berlin")
@@ -589,12 +804,14 @@ def run_now(dry_run: bool = False, allow_resend: bool = False, selected_files: O
     """
     logger.info("Manual invoice processing triggered")
     processor = get_processor()
-    return processor.process_invoices(
-        force_send=True,
-        dry_run=dry_run,
-        allow_resend=allow_resend,
-        selected_files=selected_files
-    )
+    # Dry runs have no side effects and don't need to wait for a running job
+    with nullcontext() if dry_run else _run_lock:
+        return processor.process_invoices(
+            force_send=True,
+            dry_run=dry_run,
+            allow_resend=allow_resend,
+            selected_files=selected_files
+        )
 
 
 def get_next_run_time() -> Optional[datetime]:
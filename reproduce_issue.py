@@ -3,7 +3,7 @@ import os
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 from app.database import Base
-from app.models import AppSettings
+from app.models import AppSettings, invalidate_settings_cache
 from app.config import get_settings
 
 # Mock environment variable
@@ -51,6 +51,7 @@ def test_logic():
     # Clear DB
     db.query(AppSettings).delete()
     db.commit()
+    invalidate_settings_cache()
     # Set env to valid value
     os.environ["TENANT_ID"] = "env-tenant-id"
     config.reload_settings()